@@ -35,6 +35,9 @@
         'views/product_views.xml',
         'views/website_views.xml',
         'views/res_config_settings_views.xml',
+        'views/persisted_query_views.xml',
+        'views/invalidate_cache_views.xml',
+        'views/cache_endpoint_views.xml',
         'views/menu.xml'
     ],
     'demo': [
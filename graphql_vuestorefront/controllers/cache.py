@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import hashlib
+import json
+
+from graphql.language import FieldNode, FragmentDefinitionNode, FragmentSpreadNode, InlineFragmentNode
+from odoo.models import BaseModel
+
+# Root fields whose result is the same for every anonymous visitor of a website, language and pricelist
+CACHEABLE_ROOT_FIELDS = {
+    '__typename', 'product', 'products', 'productSuggest', 'productVariant', 'attribute', 'category', 'categories',
+    'country', 'countries', 'websiteMenu', 'websiteMegaMenu', 'websiteFooter', 'websiteHomepage',
+}
+
+# Root fields listing menus, tagged with WM alone as a new menu changes them
+MENU_ROOT_FIELDS = {'websiteMenu', 'websiteMegaMenu', 'websiteFooter'}
+
+# Fields that depend on the visitor session (cart, wishlist) wherever they are selected
+SESSION_FIELDS = {'isInWishlist'}
+
+# Fields computed from the stock, which changes with every stock move and never invalidates the caches
+STOCK_FIELDS = {'qty', 'isInStock', 'status'}
+
+
+def iter_selected_fields(selection_set, fragments):
+    """ Every field of the selection set, at any depth, fragments included """
+    for selection in selection_set.selections if selection_set else []:
+        if isinstance(selection, FieldNode):
+            yield selection
+            yield from iter_selected_fields(selection.selection_set, fragments)
+        elif isinstance(selection, InlineFragmentNode):
+            yield from iter_selected_fields(selection.selection_set, fragments)
+        elif isinstance(selection, FragmentSpreadNode):
+            fragment = fragments.get(selection.name.value)
+            if fragment:
+                yield from iter_selected_fields(fragment.selection_set, fragments)
+
+
+def is_cacheable_operation(document, operation):
+    fragments = {
+        definition.name.value: definition for definition in document.definitions
+        if isinstance(definition, FragmentDefinitionNode)
+    }
+    root_fields = [
+        selection.name.value for selection in operation.selection_set.selections if isinstance(selection, FieldNode)
+    ]
+    if len(root_fields) != len(operation.selection_set.selections) or \
+            not CACHEABLE_ROOT_FIELDS.issuperset(root_fields):
+        return False
+    return not any(field.name.value in SESSION_FIELDS or field.name.value in STOCK_FIELDS
+                   for field in iter_selected_fields(operation.selection_set, fragments))
+
+
+def get_response_cache_key(dbname, website, lang, pricelist, fiscal_position, sha256_hash, operation_name,
+                           variables):
+    """ The memory cache is shared by the databases of the worker, the key is unique across them """
+    key = json.dumps([dbname, website.id, lang, pricelist.id, fiscal_position.id, sha256_hash, operation_name,
+                      variables or {}], sort_keys=True, default=str)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def get_cache_tag_headers(tags):
+    """ Tags of a response for the edge caches, Cache-Tag is comma separated and Surrogate-Key space separated """
+    if not tags:
+        return {}
+    tags = sorted(tags)
+    return {
+        'Cache-Tag': ','.join(tags),
+        'Surrogate-Key': ' '.join(tags),
+    }
+
+
+class CacheTagCollector(object):
+    """
+    GraphQL middleware recording the tags of the records serialized by the resolvers, in the vocabulary of
+    invalidate.cache: P<id> for product templates (variants count for their template), C<id> for categories,
+    WR<id> for rewrites and WM<id> for menus. Product lists are tagged with the categories they are filtered on,
+    or with P alone, and menu lists with WM alone. Every response is tagged with PL<id>, the pricelist of its
+    prices.
+    """
+
+    def __init__(self, pricelist=None):
+        self.tags = set()
+        if pricelist:
+            self.tags.add(f'PL{pricelist.id}')
+
+    def resolve(self, next, root, info, **args):
+        if info.parent_type.name == 'Query' and info.field_name == 'products':
+            category_ids = (args.get('filter') or {}).get('category_id')
+            if category_ids:
+                self.tags.update(f'C{category_id}' for category_id in category_ids)
+            else:
+                self.tags.add('P')
+        elif info.parent_type.name == 'Query' and info.field_name in MENU_ROOT_FIELDS:
+            self.tags.add('WM')
+        value = next(root, info, **args)
+        if isinstance(value, BaseModel):
+            self._collect(value)
+        return value
+
+    def _collect(self, records):
+        if records._name == 'product.template':
+            self.tags.update(f'P{product_id}' for product_id in records.ids)
+        elif records._name == 'product.product':
+            self.tags.update(f'P{product_id}' for product_id in records.product_tmpl_id.ids)
+        elif records._name == 'product.public.category':
+            self.tags.update(f'C{category_id}' for category_id in records.ids)
+        elif records._name == 'website.rewrite':
+            self.tags.update(f'WR{rewrite_id}' for rewrite_id in records.ids)
+        elif records._name == 'website.menu':
+            self.tags.update(f'WM{menu_id}' for menu_id in records.ids)
@@ -3,21 +3,65 @@
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
 import os
+import hashlib
 import json
 import logging
 import pprint
+from datetime import datetime, timezone
 
+from graphql import ExecutionResult, GraphQLError, OperationType, execute, parse, validate
+from graphql.utilities import get_operation_ast
 from odoo import http
 from odoo.addons.web.controllers.binary import Binary
 from odoo.addons.graphql_base import GraphQLControllerMixin
 from odoo.http import request, Response
+from odoo.tools.lru import LRU
 from urllib.parse import urlparse
 from werkzeug.exceptions import Forbidden
 
+from ..models.website_sitemap import SITEMAP_INDEX_NAME
 from ..schema import schema
+from .cache import CacheTagCollector, get_cache_tag_headers, get_response_cache_key, is_cacheable_operation
 
 _logger = logging.getLogger(__name__)
 
+# Parsed and validated documents of this worker, by sha256 hash of the query
+PARSED_DOCUMENTS = LRU(1024)
+
+STREAM_CHUNK_SIZE = 2000
+
+
+def stream_json_array(registry, query, params, serialize):
+    """
+    Generates a JSON array from the rows of the query, read by chunks of ids so the memory use doesn't depend on
+    the number of rows. The response is streamed after the request cursor is closed, so it uses its own cursor.
+    The query selects the id first and ends with "id > %s ORDER BY id LIMIT %s".
+    """
+    yield '['
+    separator = ''
+    last_id = 0
+    with registry.cursor() as cr:
+        while True:
+            cr.execute(query, params + (last_id, STREAM_CHUNK_SIZE))
+            rows = cr.fetchall()
+            if not rows:
+                break
+            yield separator + ','.join(json.dumps(serialize(row)) for row in rows)
+            separator = ','
+            last_id = rows[-1][0]
+            if len(rows) < STREAM_CHUNK_SIZE:
+                break
+    yield ']'
+
+
+def serialize_product_slug(row):
+    slug = row[1]
+    name = os.path.basename(urlparse(slug).path)
+    return {
+        'name': name,
+        'path': '{}:slug'.format(slug.replace(name, '')),
+    }
+
 
 class VSFBinary(Binary):
     @http.route(['/web/image',
@@ -88,7 +132,236 @@ class GraphQLController(http.Controller, GraphQLControllerMixin):
                 _logger.info('# ------------------------------------------------------------------------------------ #')
             except:
                 pass
-        return super(GraphQLController, self)._process_request(schema, data)
+        if isinstance(data, list):
+            # Batched operations are not sent by VSF
+            response = super(GraphQLController, self)._process_request(schema, data)
+        else:
+            response = self._process_graphql_request(schema, data)
+        if vsf_debug_mode:
+            pricing_memo = getattr(http.request, 'vsf_pricing_memo', None)
+            if pricing_memo:
+                _logger.info('Pricing memo: %s hits, %s misses', pricing_memo.hits, pricing_memo.misses)
+                response.headers['X-VSF-Pricing-Memo'] = 'hits=%s, misses=%s' % (
+                    pricing_memo.hits, pricing_memo.misses)
+        return response
+
+    def _make_graphql_response(self, result, status_code=200, headers=None):
+        if not isinstance(result, str):
+            result = json.dumps(result, separators=(',', ':'))
+        response = http.request.make_response(
+            result,
+            headers=dict(headers or {}, **{'Content-Type': 'application/json'}),
+        )
+        response.status_code = status_code
+        return response
+
+    def _make_graphql_error(self, message, status_code=200, code=None, headers=None):
+        error = {'message': message}
+        if code:
+            error['extensions'] = {'code': code}
+        return self._make_graphql_response({'errors': [error]}, status_code, headers)
+
+    def _get_graphql_params(self, data):
+        """ Query, variables, operation name and extensions of the body, or of the url for GET requests """
+        args = http.request.httprequest.args
+        params = {}
+        for name in ('query', 'variables', 'operationName', 'extensions'):
+            value = data.get(name) or args.get(name)
+            if name in ('variables', 'extensions') and isinstance(value, str):
+                value = json.loads(value)
+            params[name] = value
+        return params
+
+    def _process_graphql_request(self, schema, data):
+        """
+        Executes an operation with Automatic Persisted Queries support.
+
+        The documents are parsed and validated once per worker, then reused by sha256 hash of the query. A client
+        can send only the hash of the query, it's asked to send the query again if the hash is unknown, and the
+        query is then registered. In strict mode only the registered operations are executed.
+        """
+        env = http.request.env
+        httprequest = http.request.httprequest
+        try:
+            params = self._get_graphql_params(data)
+        except ValueError:
+            return self._make_graphql_error('Variables or extensions are invalid JSON.', 400)
+
+        query = params['query']
+        operation_name = params['operationName']
+        persisted_query = (params['extensions'] or {}).get('persistedQuery') or {}
+        sha256_hash = persisted_query.get('sha256Hash')
+        PersistedQuery = env['vsf.persisted.query'].sudo()
+
+        if sha256_hash:
+            if not query:
+                query = PersistedQuery._get_query(sha256_hash)
+                if not query:
+                    return self._make_graphql_error('PersistedQueryNotFound', code='PERSISTED_QUERY_NOT_FOUND')
+            elif hashlib.sha256(query.encode('utf-8')).hexdigest() != sha256_hash:
+                return self._make_graphql_error('Provided sha does not match query.', 400)
+        elif query:
+            sha256_hash = hashlib.sha256(query.encode('utf-8')).hexdigest()
+        else:
+            return self._make_graphql_error('Must provide query string.', 400)
+
+        ICP = env['ir.config_parameter'].sudo()
+        is_registered = bool(PersistedQuery._get_query(sha256_hash))
+        if not is_registered and ICP.get_param('vsf_persisted_queries_strict', False) and \
+                not env.user._is_internal():
+            return self._make_graphql_error('Only persisted queries are allowed.', 400,
+                                            code='PERSISTED_QUERY_NOT_ALLOWED')
+
+        document = PARSED_DOCUMENTS.get(sha256_hash)
+        if document is None:
+            try:
+                document = parse(query)
+            except GraphQLError as error:
+                return self._make_graphql_response(ExecutionResult(None, [error]).formatted, 400)
+            errors = validate(schema, document)
+            if errors:
+                return self._make_graphql_response(ExecutionResult(None, errors).formatted, 400)
+            PARSED_DOCUMENTS[sha256_hash] = document
+
+        operation = get_operation_ast(document, operation_name)
+        if httprequest.method == 'GET' and operation and operation.operation != OperationType.QUERY:
+            return self._make_graphql_error(
+                'Can only perform a %s operation from a POST request.' % operation.operation.value, 405,
+                headers={'Allow': 'POST'})
+
+        ResponseCache = env['vsf.response.cache'].sudo()
+        cache_key = self._get_response_cache_key(document, operation, sha256_hash, operation_name,
+                                                 params['variables'])
+        etag = None
+        if httprequest.method == 'GET' and cache_key:
+            # The response only depends on the catalog and the key
+            etag = self._get_catalog_etag(cache_key)
+            if httprequest.if_none_match.contains(etag):
+                return self._make_not_modified(etag)
+
+        if not ResponseCache._is_enabled():
+            cache_key = None
+        cached = cache_key and ResponseCache._get(cache_key)
+        status_code = 200
+        headers = {}
+        if cached:
+            body, tags = cached
+            headers['X-VSF-Cache'] = 'HIT'
+        else:
+            collector = CacheTagCollector(env['website'].get_current_website()._get_current_pricelist())
+            result = execute(
+                schema, document,
+                context_value={'env': env},
+                variable_values=params['variables'],
+                operation_name=operation_name,
+                middleware=[collector],
+            )
+            body = json.dumps(result.formatted, separators=(',', ':'))
+            tags = collector.tags
+            if result.errors:
+                tags = None
+                if any(not error.path for error in result.errors):
+                    status_code = 400
+                env.cr.rollback()
+                env.clear()
+            elif cache_key:
+                ResponseCache._set(cache_key, body, collector.tags)
+            if cache_key:
+                headers['X-VSF-Cache'] = 'MISS'
+        if operation and operation.operation == OperationType.QUERY:
+            headers.update(get_cache_tag_headers(tags))
+
+        if persisted_query and not is_registered:
+            # Registered after the rollback of a failed operation, the document is valid anyway
+            PersistedQuery._register_query(sha256_hash, query, operation_name)
+
+        if httprequest.method == 'GET' and status_code == 200:
+            etag = etag or hashlib.sha256(body.encode('utf-8')).hexdigest()
+            if httprequest.if_none_match.contains(etag):
+                return self._make_not_modified(etag)
+        response = self._make_graphql_response(body, status_code, headers)
+        if etag and status_code == 200:
+            response.set_etag(etag)
+        return response
+
+    def _get_response_cache_key(self, document, operation, sha256_hash, operation_name, variables):
+        """
+        Key of the response in the response cache, None when the response must not be cached: the operation is
+        not a catalog query or the visitor is logged in.
+        """
+        env = http.request.env
+        if not operation or operation.operation != OperationType.QUERY or not env.user._is_public():
+            return None
+        if not is_cacheable_operation(document, operation):
+            return None
+        website = env['website'].get_current_website()
+        return get_response_cache_key(env.cr.dbname, website, env.lang, website._get_current_pricelist(),
+                                      website.fiscal_position_id, sha256_hash, operation_name, variables)
+
+    def _get_catalog_etag(self, *variant):
+        """ Strong ETag of a response that only depends on the catalog version and the variant """
+        version = request.env['invalidate.cache'].sudo().get_catalog_version()
+        digest = hashlib.sha1(json.dumps(variant, default=str).encode('utf-8')).hexdigest()
+        return '%s-%s' % (version, digest[:16])
+
+    def _get_vsf_endpoint_etag(self):
+        """ ETag of the /vsf/* endpoints, computed from the request alone as they don't depend on the user """
+        httprequest = request.httprequest
+        return self._get_catalog_etag(httprequest.headers.environ.get('HTTP_RESQUEST_HOST'), httprequest.full_path)
+
+    def _get_delta_since(self, since):
+        """ UTC datetime of the since parameter of the delta endpoints, an ISO 8601 date and time """
+        if not since:
+            raise ValueError('since is required')
+        # fromisoformat() only accepts the Z suffix since Python 3.11
+        if since.endswith(('Z', 'z')):
+            since = since[:-1] + '+00:00'
+        since = datetime.fromisoformat(since)
+        if since.tzinfo:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        return since
+
+    def _make_delta_error(self, message):
+        return Response(json.dumps({'error': message}), status=400, headers={'Content-Type': 'application/json'})
+
+    def _get_delta_until(self):
+        """
+        Date to use as since for the next delta. Transactions still running may commit changes with an earlier
+        write date than now, so it's the start of the oldest one. Their write date is that start exactly, the
+        deltas select the changes since that date included.
+        """
+        cr = request.env.cr
+        cr.execute("""
+            SELECT LEAST(now(), min(xact_start)) at time zone 'UTC'
+            FROM pg_stat_activity
+            WHERE datname = current_database() AND xact_start IS NOT NULL AND pid != pg_backend_pid()
+        """)
+        return cr.fetchone()[0]
+
+    def _make_delta_response(self, since, changed, removed):
+        """
+        Delta response of the slugs changed and removed since the date, or 410 Gone if the tombstones of the
+        removed slugs are not kept since then and everything must be fetched again.
+        """
+        if since < request.env['vsf.tombstone'].sudo().get_retention_date():
+            return Response(json.dumps({'error': 'since is older than the tombstone retention'}), status=410,
+                            headers={'Content-Type': 'application/json'})
+        until = self._get_delta_until()
+        changed_keys = {json.dumps(item, sort_keys=True) for item in changed}
+        return Response(
+            json.dumps({
+                'since': since.isoformat(),
+                'until': until.isoformat(),
+                'changed': changed,
+                'removed': [item for item in removed if json.dumps(item, sort_keys=True) not in changed_keys],
+            }),
+            headers={'Content-Type': 'application/json'},
+        )
+
+    def _make_not_modified(self, etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
 
     def _set_website_context(self):
         """Set website context based on http_request_host header."""
@@ -139,63 +412,206 @@ class GraphQLController(http.Controller, GraphQLControllerMixin):
 
     @http.route('/vsf/categories', type='http', auth='public', csrf=False)
     def vsf_categories(self):
+        etag = self._get_vsf_endpoint_etag()
+        if request.httprequest.if_none_match.contains(etag):
+            return self._make_not_modified(etag)
+
         self._set_website_context()
         website = request.env['website'].get_current_website()
 
-        categories = []
-
         if website.default_lang_id:
+            query = """
+                SELECT id, COALESCE(website_slug->>%s, website_slug->>'en_US') AS slug
+                FROM product_public_category
+                WHERE COALESCE(website_slug->>%s, website_slug->>'en_US', '') != ''
+                AND id > %s
+                ORDER BY id
+                LIMIT %s
+            """
             lang_code = website.default_lang_id.code
-            domain = [('website_slug', '!=', False)]
+            categories = stream_json_array(request.env.registry, query, (lang_code, lang_code), lambda row: row[1])
+        else:
+            categories = ['[]']
 
-            for category in request.env['product.public.category'].sudo().search(domain):
-                category = category.with_context(lang=lang_code)
-                categories.append(category.website_slug)
-
-        return Response(
-            json.dumps(categories),
+        response = Response(
+            categories,
             headers={'Content-Type': 'application/json'},
         )
+        response.set_etag(etag)
+        return response
 
     @http.route('/vsf/products', type='http', auth='public', csrf=False)
     def vsf_products(self):
+        etag = self._get_vsf_endpoint_etag()
+        if request.httprequest.if_none_match.contains(etag):
+            return self._make_not_modified(etag)
+
         self._set_website_context()
         website = request.env['website'].get_current_website()
 
-        products = []
-
         if website.default_lang_id:
+            query = """
+                SELECT id, COALESCE(website_slug->>%s, website_slug->>'en_US') AS slug
+                FROM product_template
+                WHERE is_published AND active
+                AND (website_id IS NULL OR website_id = %s)
+                AND COALESCE(website_slug->>%s, website_slug->>'en_US', '') != ''
+                AND id > %s
+                ORDER BY id
+                LIMIT %s
+            """
             lang_code = website.default_lang_id.code
-            domain = [('website_published', '=', True), ('website_slug', '!=', False)]
+            products = stream_json_array(request.env.registry, query, (website.id, lang_code, lang_code),
+                                         serialize_product_slug)
+        else:
+            products = ['[]']
 
-            for product in request.env['product.template'].sudo().search(domain):
-                product = product.with_context(lang=lang_code)
+        response = Response(
+            products,
+            headers={'Content-Type': 'application/json'},
+        )
+        response.set_etag(etag)
+        return response
 
-                url_parsed = urlparse(product.website_slug)
-                name = os.path.basename(url_parsed.path)
-                path = product.website_slug.replace(name, '')
+    @http.route('/vsf/categories/changes', type='http', auth='public', csrf=False)
+    def vsf_categories_changes(self, since=None):
+        try:
+            since = self._get_delta_since(since)
+        except ValueError as e:
+            return self._make_delta_error(str(e))
 
-                products.append({
-                    'name': name,
-                    'path': '{}:slug'.format(path),
-                })
+        self._set_website_context()
+        website = request.env['website'].get_current_website()
+        lang_code = website.default_lang_id.code or 'en_US'
+        cr = request.env.cr
+        slug = "COALESCE(website_slug->>%(lang)s, website_slug->>'en_US')"
+        params = {'lang': lang_code, 'since': since}
+
+        cr.execute(f"""
+            SELECT {slug} FROM product_public_category
+            WHERE write_date >= %(since)s AND COALESCE({slug}, '') != ''
+            ORDER BY id
+        """, params)
+        changed = [row[0] for row in cr.fetchall()]
+        cr.execute(f"""
+            SELECT DISTINCT {slug} FROM vsf_tombstone
+            WHERE res_model = 'product.public.category' AND create_date >= %(since)s AND COALESCE({slug}, '') != ''
+        """, params)
+        removed = [row[0] for row in cr.fetchall()]
+        return self._make_delta_response(since, changed, removed)
+
+    @http.route('/vsf/products/changes', type='http', auth='public', csrf=False)
+    def vsf_products_changes(self, since=None):
+        try:
+            since = self._get_delta_since(since)
+        except ValueError as e:
+            return self._make_delta_error(str(e))
 
-        return Response(
-            json.dumps(products),
-            headers={'Content-Type': 'application/json'},
-        )
+        self._set_website_context()
+        website = request.env['website'].get_current_website()
+        lang_code = website.default_lang_id.code or 'en_US'
+        cr = request.env.cr
+        slug = "COALESCE(website_slug->>%(lang)s, website_slug->>'en_US')"
+        params = {'lang': lang_code, 'since': since, 'website_id': website.id}
+        published = "is_published AND active AND (website_id IS NULL OR website_id = %(website_id)s)"
+
+        cr.execute(f"""
+            SELECT id, {slug} FROM product_template
+            WHERE write_date >= %(since)s AND {published} AND COALESCE({slug}, '') != ''
+            ORDER BY id
+        """, params)
+        changed = [serialize_product_slug(row) for row in cr.fetchall()]
+        # Unpublished, archived or moved to another website, the products are removed from the storefront too
+        cr.execute(f"""
+            SELECT id, {slug} FROM product_template
+            WHERE write_date >= %(since)s AND NOT ({published}) AND COALESCE({slug}, '') != ''
+            UNION
+            SELECT res_id, {slug} FROM vsf_tombstone
+            WHERE res_model = 'product.template' AND create_date >= %(since)s AND COALESCE({slug}, '') != ''
+        """, params)
+        removed = [serialize_product_slug(row) for row in cr.fetchall()]
+        return self._make_delta_response(since, changed, removed)
 
     @http.route('/vsf/redirects', type='http', auth='public', csrf=False)
-    def vsf_redirects(self):
-        redirects = []
+    def vsf_redirects(self, version=None):
+        """
+        Compiled redirect map, with its version as ETag. A client that knows the current version gets a 304, with
+        ?version= or If-None-Match, without the map being read.
+        """
+        Rewrite = request.env['website.rewrite'].sudo()
+        current_version = str(Rewrite._vsf_get_redirect_map_version())
+        etag = 'redirects-%s' % current_version
+        if current_version != '0' and (version == current_version or request.httprequest.if_none_match.contains(etag)):
+            return self._make_not_modified(etag)
+
+        current_version, redirect_map = Rewrite._vsf_get_redirect_map()
+        response = Response(
+            redirect_map,
+            headers={'Content-Type': 'application/json', 'X-VSF-Redirects-Version': str(current_version)},
+        )
+        response.set_etag('redirects-%s' % current_version)
+        return response
+
+    @http.route('/vsf/redirects/resolve', type='http', auth='public', csrf=False)
+    def vsf_redirects_resolve(self, path=None):
+        """ Redirect of a single path, for edge middlewares, 404 if the path is not redirected """
+        redirect = path and request.env['website.rewrite'].sudo().vsf_resolve_redirect(path)
+        if not redirect:
+            return request.not_found()
+        return Response(json.dumps(redirect), headers={'Content-Type': 'application/json'})
+
+    @http.route('/vsf/redirects/changes', type='http', auth='public', csrf=False)
+    def vsf_redirects_changes(self, since=None):
+        try:
+            since = self._get_delta_since(since)
+        except ValueError as e:
+            return self._make_delta_error(str(e))
+
+        cr = request.env.cr
+        cr.execute("""
+            SELECT url_from, url_to FROM website_rewrite
+            WHERE write_date >= %s AND active
+            ORDER BY id
+        """, (since,))
+        changed = [{'from': url_from, 'to': url_to} for url_from, url_to in cr.fetchall()]
+        cr.execute("""
+            SELECT url_from FROM website_rewrite
+            WHERE write_date >= %s AND NOT active
+            UNION
+            SELECT website_slug->>'en_US' FROM vsf_tombstone
+            WHERE res_model = 'website.rewrite' AND create_date >= %s
+        """, (since, since))
+        removed = [{'from': url_from} for url_from, in cr.fetchall()]
+        changed_from = {redirect['from'] for redirect in changed}
+        return self._make_delta_response(
+            since, changed, [redirect for redirect in removed if redirect['from'] not in changed_from])
+
+    def _make_vsf_sitemap_response(self, name):
+        """ Serves a sitemap file stored by the cron, the sitemaps are never rendered by the request """
+        website = request.env['website'].get_current_website()
+        attachment = request.env['ir.attachment'].sudo().search([
+            ('res_model', '=', 'website'),
+            ('res_id', '=', website.id),
+            ('name', '=', name),
+        ], limit=1)
+        if not attachment:
+            return request.not_found()
 
-        for redirect in request.env['website.rewrite'].sudo().search([]):
-            redirects.append({
-                'from': redirect.url_from,
-                'to': redirect.url_to,
-            })
+        response = Response(attachment.raw, headers={'Content-Type': attachment.mimetype})
+        response.last_modified = attachment.write_date
+        response.set_etag(attachment.checksum)
+        return response.make_conditional(request.httprequest)
 
-        return Response(
-            json.dumps(redirects),
-            headers={'Content-Type': 'application/json'},
-        )
+    @http.route('/vsf/sitemap.xml', type='http', auth='public', csrf=False)
+    def vsf_sitemap_index(self):
+        self._set_website_context()
+        website = request.env['website'].get_current_website()
+        return self._make_vsf_sitemap_response(SITEMAP_INDEX_NAME.format(website=website.id))
+
+    @http.route('/vsf/sitemap/<string:name>', type='http', auth='public', csrf=False)
+    def vsf_sitemap(self, name):
+        self._set_website_context()
+        website = request.env['website'].get_current_website()
+        if not name.startswith('vsf-sitemap-%s-' % website.id) or not name.endswith('.xml.gz'):
+            return request.not_found()
+        return self._make_vsf_sitemap_response(name)
@@ -2,9 +2,18 @@
 # Copyright 2024 ERPGAP/PROMPTEQUATION LDA
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
+from . import cache_endpoint
 from . import invalidate_cache
+from . import persisted_query
+from . import response_cache
+from . import tombstone
 from . import website
+from . import website_sitemap
 from . import product
+from . import product_pricelist
+from . import res_currency
+from . import res_lang
+from . import account_fiscal_position
 from . import res_config_settings
 from . import res_users
 from . import payment_transaction
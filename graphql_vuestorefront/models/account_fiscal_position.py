@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+from odoo import models
+from odoo.addons.graphql_vuestorefront.models.product_pricelist import get_price_rule_batch
+
+
+class AccountFiscalPosition(models.Model):
+    _inherit = 'account.fiscal.position'
+
+    def map_tax(self, taxes):
+        """ Inside a price rule batch each set of taxes is mapped once for all the products """
+        batch = get_price_rule_batch()
+        if not batch:
+            return super(AccountFiscalPosition, self).map_tax(taxes)
+
+        key = (self.id, tuple(taxes.ids))
+        if key not in batch.taxes:
+            batch.taxes[key] = super(AccountFiscalPosition, self).map_tax(taxes).ids
+        return self.env['account.tax'].browse(batch.taxes[key])
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+from odoo import models, fields, api
+
+
+class VsfCacheEndpoint(models.Model):
+    _name = 'vsf.cache.endpoint'
+    _description = 'VSF Cache Invalidation Endpoint'
+    _order = 'website_id, sequence, id'
+
+    name = fields.Char('Name', required=True)
+    sequence = fields.Integer('Sequence', default=10)
+    active = fields.Boolean('Active', default=True)
+    website_id = fields.Many2one('website', 'Website', ondelete='cascade')
+    url = fields.Char('Url', required=True)
+    key = fields.Char('Key', groups='base.group_system')
+    purge_format = fields.Selection([
+        ('vsf', 'Storefront (form key and tags)'),
+        ('json', 'JSON (key and tags)'),
+        ('surrogate_key', 'Surrogate-Key header'),
+        ('cloudflare', 'Cloudflare (purge by tags)'),
+    ], string='Format', required=True, default='vsf')
+    chunk_size = fields.Integer('Tags per Request', required=True, default=500)
+    tag_prefix = fields.Char('Tag Prefix', help='Prepended to the tags, when the endpoint tags the responses of '
+                                                'several sites')
+    success_count = fields.Integer('Successful Purges', readonly=True)
+    failure_count = fields.Integer('Failed Purges', readonly=True)
+    last_purge_date = fields.Datetime('Last Purge', readonly=True)
+    last_duration = fields.Float('Last Duration (s)', digits=(16, 3), readonly=True)
+    last_error = fields.Text('Last Error', readonly=True)
+
+    _sql_constraints = [
+        ('chunk_size_positive', 'CHECK(chunk_size > 0)', 'The tags per request must be positive.'),
+    ]
+
+    @api.model
+    def _record_purges(self, results):
+        """ Statistics of the purges, results are (endpoint id, duration, error) """
+        now = fields.Datetime.now()
+        for endpoint_id, duration, error in results:
+            self.env.cr.execute("""
+                UPDATE vsf_cache_endpoint
+                SET success_count = success_count + %s, failure_count = failure_count + %s,
+                    last_purge_date = %s, last_duration = %s, last_error = %s
+                WHERE id = %s
+            """, (0 if error else 1, 1 if error else 0, now, duration, error, endpoint_id))
+        self.invalidate_model(['success_count', 'failure_count', 'last_purge_date', 'last_duration', 'last_error'])
@@ -2,111 +2,444 @@
 # Copyright 2024 ERPGAP/PROMPTEQUATION LDA
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
+import contextlib
 import logging
-from datetime import datetime
+import selectors
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import psycopg2
 import requests
-from odoo import models, fields, api
+import odoo
+from datetime import timedelta
+from requests.adapters import HTTPAdapter
+
+from odoo import models, fields, api, tools, SUPERUSER_ID
+from odoo.tools import SQL
 
 _logger = logging.getLogger(__name__)
 
+# Channel notified when records are queued, the payload is the database name
+INVALIDATION_CHANNEL = 'vsf_cache_invalidation'
+# Key of the advisory lock held by the server dispatching the invalidations of a database
+INVALIDATION_LOCK = 0x76736663
+# Seconds between two attempts to take the lock held by another server
+INVALIDATION_LOCK_RETRY = 30
+# Seconds without notification after which the queue is drained anyway, for the retries that became due
+INVALIDATION_SELECT_TIMEOUT = 60
+
+# Purge worker: records claimed per batch, seconds a claim is kept before another worker takes it over, delay of
+# the first retry in seconds, doubled on every attempt, and attempts before an invalidation is dead-lettered
+INVALIDATION_BATCH_SIZE = 1000
+INVALIDATION_CLAIM_TIMEOUT = 300
+INVALIDATION_RETRY_DELAY = 30
+INVALIDATION_MAX_ATTEMPTS = 8
+
+# Keep-alive HTTP session of every purge url, shared by the workers of the process
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
+# Endpoints purged at the same time
+ENDPOINTS_MAX_WORKERS = 8
+
+# Tags method of every model queued for invalidation
+INVALIDATION_TAGS_METHODS = {
+    'product.template': '_get_product_tags',
+    'product.public.category': '_get_category_tags',
+    'website.menu': '_get_menu_tags',
+    'website.rewrite': '_get_rewrite_tags',
+    'product.pricelist': '_get_pricelist_tags',
+}
+
+
+class InvalidationDispatcher(threading.Thread):
+    """
+    Thread listening to the invalidation channel of a database. A notification is received when a transaction that
+    queued records commits. The notifications are debounced over vsf_cache_invalidation_debounce milliseconds and
+    the queue is then drained with a single request_vsf_cache_invalidation call. One server per database
+    dispatches, the one holding the advisory lock, the cron is the fallback.
+    """
+
+    def __init__(self, dbname):
+        super().__init__(daemon=True, name=f'{__name__}.InvalidationDispatcher({dbname})')
+        self.dbname = dbname
+
+    def loop(self):
+        with odoo.sql_db.db_connect(self.dbname).cursor() as cr, selectors.DefaultSelector() as sel:
+            try:
+                cr.execute('SELECT pg_try_advisory_lock(%s)', (INVALIDATION_LOCK,))
+                if not cr.fetchone()[0]:
+                    cr.commit()
+                    time.sleep(INVALIDATION_LOCK_RETRY)
+                    return
+                cr.execute(f'LISTEN {INVALIDATION_CHANNEL}')
+                cr.commit()
+                _logger.info('VSF invalidation dispatcher listening on %s', self.dbname)
+                # Records queued before listening
+                self.dispatch()
+                conn = cr._cnx
+                sel.register(conn, selectors.EVENT_READ)
+                while True:
+                    if not sel.select(INVALIDATION_SELECT_TIMEOUT):
+                        self.dispatch()
+                        continue
+                    conn.poll()
+                    if not conn.notifies:
+                        continue
+                    # Coalesce the notifications of the debounce window
+                    time.sleep(self.get_debounce())
+                    conn.poll()
+                    conn.notifies.clear()
+                    self.dispatch()
+            finally:
+                # The connection goes back to the pool, a broken one releases its lock when it is closed
+                with contextlib.suppress(psycopg2.Error):
+                    cr.rollback()
+                    cr.execute(f'UNLISTEN {INVALIDATION_CHANNEL}')
+                    cr.execute('SELECT pg_advisory_unlock_all()')
+                    cr.commit()
+
+    def get_debounce(self):
+        with odoo.registry(self.dbname).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            return env['invalidate.cache']._get_cache_invalidation_settings()['debounce'] / 1000.0
+
+    def dispatch(self):
+        with odoo.registry(self.dbname).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env['invalidate.cache'].request_vsf_cache_invalidation()
+
+    def run(self):
+        while True:
+            try:
+                self.loop()
+            except Exception:
+                _logger.exception('VSF invalidation dispatcher of %s failed, restarting', self.dbname)
+                time.sleep(INVALIDATION_LOCK_RETRY)
+
+
+# Dispatcher thread of every database, started by the first invalidation committed in this process
+DISPATCHERS = {}
+DISPATCHERS_LOCK = threading.Lock()
+
+
+def get_session(url, pool_size):
+    with SESSIONS_LOCK:
+        session = SESSIONS.get(url)
+        if session is None:
+            session = SESSIONS[url] = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        return session
+
+
+def get_purge_request(purge_format, key, tags):
+    """ Arguments of the POST request purging the tags, in the format of the endpoint """
+    if purge_format == 'json':
+        return {'json': {'key': key, 'tags': tags}}
+    if purge_format == 'surrogate_key':
+        return {'headers': {'Surrogate-Key': ' '.join(tags), 'Fastly-Key': key or ''}}
+    if purge_format == 'cloudflare':
+        return {'json': {'tags': tags}, 'headers': {'Authorization': 'Bearer %s' % key}}
+    return {'data': {'key': key, 'tags': ','.join(tags)}}
+
+
+def send_purge(url, key, tags, purge_format='vsf', chunk_size=500, concurrency=4):
+    """
+    Sends the purge as POST requests of chunk_size tags at most, in parallel over a keep-alive session, and raises
+    if any of them did not succeed. Purging a tag twice is harmless, a failed purge is sent again whole.
+    """
+    chunks = [tags[index:index + chunk_size] for index in range(0, len(tags), chunk_size)]
+    session = get_session(url, concurrency)
+
+    def purge(chunk):
+        start = time.time()
+        response = session.post(url, timeout=5, **get_purge_request(purge_format, key, chunk))
+        _logger.info('VSF cache invalidation of %s tags on %s: %s in %.3fs', len(chunk), url,
+                     response.status_code, time.time() - start)
+        response.raise_for_status()
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks))) as executor:
+        # Consuming the results raises the first error
+        list(executor.map(purge, chunks))
+    _logger.info('VSF cache invalidation of %s tags on %s in %s requests: %.3fs', len(tags), url, len(chunks),
+                 time.time() - start)
+
+
+def start_dispatcher(dbname):
+    with DISPATCHERS_LOCK:
+        dispatcher = DISPATCHERS.get(dbname)
+        if dispatcher is None or not dispatcher.is_alive():
+            dispatcher = DISPATCHERS[dbname] = InvalidationDispatcher(dbname)
+            dispatcher.start()
+
 
 class InvalidateCache(models.Model):
     _name = 'invalidate.cache'
     _description = 'VSF Invalidate Cache'
 
+    _order = 'id'
+
     res_model = fields.Char('Res Model', required=True, index=True)
     res_id = fields.Integer('Res ID', required=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('failed', 'Failed'),
+    ], string='State', required=True, default='pending', index=True)
+    endpoint_id = fields.Many2one('vsf.cache.endpoint', 'Endpoint', ondelete='cascade', readonly=True,
+                                  help='Empty for the url of the settings')
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_attempt = fields.Datetime('Next Attempt', readonly=True)
+    last_error = fields.Text('Last Error', readonly=True)
 
     def init(self):
         super().init()
-        self.env.cr.execute("""
-            CREATE INDEX IF NOT EXISTS invalidate_cache_find_idx
-            ON invalidate_cache(res_model, res_id);
-        """)
+        # A record is queued once per endpoint, the enqueue is a single INSERT ... ON CONFLICT
+        if not tools.sql.index_exists(self.env.cr, 'invalidate_cache_target_uniq'):
+            self.env.cr.execute("""
+                DELETE FROM invalidate_cache ic
+                USING invalidate_cache duplicate
+                WHERE duplicate.res_model = ic.res_model AND duplicate.res_id = ic.res_id
+                AND COALESCE(duplicate.endpoint_id, 0) = COALESCE(ic.endpoint_id, 0) AND duplicate.id < ic.id;
+                DROP INDEX IF EXISTS invalidate_cache_find_idx;
+                DROP INDEX IF EXISTS invalidate_cache_res_model_res_id_uniq;
+                CREATE UNIQUE INDEX invalidate_cache_target_uniq
+                ON invalidate_cache(res_model, res_id, COALESCE(endpoint_id, 0));
+            """)
+        # Catalog version of the ETags, a sequence is read and bumped without locking any row
+        self.env.cr.execute("CREATE SEQUENCE IF NOT EXISTS vsf_catalog_version;")
+
+    @api.model
+    def get_catalog_version(self):
+        self.env.cr.execute("SELECT last_value FROM vsf_catalog_version;")
+        return self.env.cr.fetchone()[0]
 
     @api.model
-    def find_invalidate_cache(self, res_model, res_id):
-        cr = self.env.cr
-        query = """
-            SELECT id
-            FROM invalidate_cache
-            WHERE res_model=%s AND res_id=%s
-            LIMIT 1;
+    def bump_catalog_version(self):
+        """
+        Bumps the catalog version now, so the responses computed during the transaction are not validated later,
+        and again after the commit, so the responses computed before the commit was visible are not either.
         """
-        params = (res_model, res_id,)
+        self.env.cr.execute("SELECT nextval('vsf_catalog_version');")
+        if not self.env.cr.postcommit.data.get('vsf_catalog_version'):
+            self.env.cr.postcommit.data['vsf_catalog_version'] = True
+            registry = self.pool
 
-        cr.execute(query, params)
-        return cr.fetchone()
+            @self.env.cr.postcommit.add
+            def bump_after_commit():
+                with registry.cursor() as cr:
+                    cr.execute("SELECT nextval('vsf_catalog_version');")
 
     @api.model
-    def create_invalidate_cache(self, res_model, res_ids):
+    @tools.ormcache()
+    def _get_cache_invalidation_settings(self):
+        """ Snapshot of the settings, cleared with the registry cache when a parameter is set """
         ICP = self.env['ir.config_parameter'].sudo()
-        cache_invalidation_enable = ICP.get_param('vsf_cache_invalidation', False)
+        return tools.frozendict(
+            enabled=bool(ICP.get_param('vsf_cache_invalidation', False)),
+            url=ICP.get_param('vsf_cache_invalidation_url', False),
+            key=ICP.get_param('vsf_cache_invalidation_key', False),
+            debounce=int(ICP.get_param('vsf_cache_invalidation_debounce', 500)),
+            chunk_size=max(int(ICP.get_param('vsf_cache_invalidation_chunk_size', 500)), 1),
+            concurrency=max(int(ICP.get_param('vsf_cache_invalidation_concurrency', 4)), 1),
+        )
 
-        if not cache_invalidation_enable:
-            return False
+    @api.model
+    def _notify_invalidation(self):
+        """ Wakes up the dispatcher when the transaction commits, PostgreSQL delivers the same notification once """
+        dbname = self.env.cr.dbname
+        self.env.cr.execute('SELECT pg_notify(%s, %s)', (INVALIDATION_CHANNEL, dbname))
+        if odoo.tools.config['test_enable'] or self.env.cr.postcommit.data.get('vsf_invalidation_dispatcher'):
+            return
+        self.env.cr.postcommit.data['vsf_invalidation_dispatcher'] = True
+        self.env.cr.postcommit.add(lambda: start_dispatcher(dbname))
 
-        for res_id in res_ids:
-            if not self.find_invalidate_cache(res_model, res_id):
-                query = """
-                    INSERT INTO invalidate_cache(res_model, res_id, create_date, write_date, create_uid, write_uid)
-                    VALUES(%s, %s, %s, %s, %s, %s);
-                """
-                now = datetime.now()
-                uid = self.env.user.id
-                params = (res_model, res_id, now, now, uid, uid,)
+    @api.model
+    def create_invalidate_cache(self, res_model, res_ids):
+        self.bump_catalog_version()
+        ResponseCache = self.env['vsf.response.cache']
+        if ResponseCache._is_enabled():
+            ResponseCache._invalidate_tags(self._get_response_cache_tags(res_model, res_ids))
 
-                self.env.cr.execute(query, params)
+        settings = self._get_cache_invalidation_settings()
+        if not settings['enabled'] or not res_ids:
+            return False
 
-    @api.model
-    def delete_invalidate_cache(self, ids):
-        if len(ids) == 1:
-            ids = '({})'.format(ids[0])
+        # The records of a website are purged on the endpoints of that website and on the ones of every website
+        Model = self.env[res_model]
+        if 'website_id' in Model._fields and Model._fields['website_id'].store:
+            Model.browse(res_ids).flush_recordset(['website_id'])
+            records = SQL("SELECT id, website_id FROM %s WHERE id = ANY(%s)",
+                          SQL.identifier(Model._table), list(res_ids))
         else:
-            ids = tuple(ids)
+            records = SQL("SELECT unnest(%s::int[]) AS id, NULL::int AS website_id", list(res_ids))
 
-        query = """
-            DELETE FROM invalidate_cache
-            WHERE id IN {};
-        """.format(ids)
+        # A record being purged or dead-lettered is queued again, its purge may have read the previous values
+        now = fields.Datetime.now()
+        uid = self.env.uid
+        self.env.cr.execute(SQL("""
+            INSERT INTO invalidate_cache(res_model, res_id, endpoint_id, state, attempts, create_date, write_date,
+                                         create_uid, write_uid)
+            SELECT %s, record.id, target.id, 'pending', 0, %s, %s, %s, %s
+            FROM (%s) AS record
+            JOIN (
+                SELECT id, website_id FROM vsf_cache_endpoint WHERE active
+                UNION ALL
+                SELECT NULL::int, NULL::int WHERE %s
+            ) AS target
+            ON target.website_id IS NULL OR record.website_id IS NULL OR target.website_id = record.website_id
+            ON CONFLICT (res_model, res_id, COALESCE(endpoint_id, 0)) DO UPDATE
+            SET state = 'pending', attempts = 0, next_attempt = NULL, last_error = NULL,
+                write_date = EXCLUDED.write_date, write_uid = EXCLUDED.write_uid
+            WHERE invalidate_cache.state != 'pending';
+        """, res_model, now, now, uid, uid, records, bool(settings['url'] and settings['key'])))
+        if self.env.cr.rowcount:
+            self._notify_invalidation()
 
-        self.env.cr.execute(query)
+    @api.model
+    def _get_purge_targets(self, endpoint_ids):
+        """ Url, key, format, tags per request and tag prefix of the endpoints, None for the url of the settings """
+        settings = self._get_cache_invalidation_settings()
+        targets = {}
+        if settings['url'] and settings['key']:
+            targets[None] = (settings['url'], settings['key'], 'vsf', settings['chunk_size'], '')
+        endpoints = self.env['vsf.cache.endpoint'].sudo().browse([
+            endpoint_id for endpoint_id in endpoint_ids if endpoint_id
+        ]).exists()
+        for endpoint in endpoints:
+            targets[endpoint.id] = (endpoint.url, endpoint.key, endpoint.purge_format, endpoint.chunk_size,
+                                    endpoint.tag_prefix or '')
+        return targets
 
     @api.model
-    def request_cache_invalidation(self, url, key, tags):
-        if url and key and tags:
-            try:
-                requests.get(url, params={'key': key, 'tags': tags}, timeout=5)
-            except Exception as e:
-                _logger.error(e)
-                self.env.cr.rollback()
+    def _claim_invalidate_caches(self, batch_size=INVALIDATION_BATCH_SIZE):
+        """
+        Claims a batch of due invalidations, and the ones whose claim expired, in a transaction of its own. The
+        rows locked by the other workers are skipped, so several workers drain the queue in parallel.
+        """
+        with self.pool.cursor() as cr:
+            cr.execute("""
+                UPDATE invalidate_cache
+                SET state = 'processing', attempts = attempts + 1,
+                    next_attempt = (now() at time zone 'UTC') + make_interval(secs => %s)
+                WHERE id IN (
+                    SELECT id
+                    FROM invalidate_cache
+                    WHERE (state = 'pending' AND (next_attempt IS NULL OR next_attempt <= (now() at time zone 'UTC'))
+                    OR state = 'processing' AND next_attempt <= (now() at time zone 'UTC'))
+                    AND (endpoint_id IS NULL OR endpoint_id IN (SELECT id FROM vsf_cache_endpoint WHERE active))
+                    ORDER BY id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, res_model, res_id, attempts, endpoint_id
+            """, (INVALIDATION_CLAIM_TIMEOUT, batch_size))
+            return cr.fetchall()
+
+    @api.model
+    def _release_invalidate_caches(self, rows, error=None):
+        """
+        Removes the purged invalidations, or schedules their retry with an exponential backoff. The records queued
+        again during the purge are pending and kept.
+        """
+        with self.pool.cursor() as cr:
+            if not error:
+                cr.execute("""
+                    DELETE FROM invalidate_cache WHERE id = ANY(%s) AND state = 'processing'
+                """, ([row[0] for row in rows],))
+                return
+            now = fields.Datetime.now()
+            for attempts in {row[3] for row in rows}:
+                failed = attempts >= INVALIDATION_MAX_ATTEMPTS
+                cr.execute("""
+                    UPDATE invalidate_cache
+                    SET state = %s, next_attempt = %s, last_error = %s
+                    WHERE id = ANY(%s) AND state = 'processing'
+                """, (
+                    'failed' if failed else 'pending',
+                    None if failed else now + timedelta(seconds=INVALIDATION_RETRY_DELAY * 2 ** (attempts - 1)),
+                    error,
+                    [row[0] for row in rows if row[3] == attempts],
+                ))
 
     @api.model
     def request_vsf_cache_invalidation(self):
-        ICP = self.env['ir.config_parameter'].sudo()
-        url = ICP.get_param('vsf_cache_invalidation_url', False)
-        key = ICP.get_param('vsf_cache_invalidation_key', False)
-
-        models = [
-            {
-                'name': 'product.template',
-                'tags_method': '_get_product_tags',
-            },
-            {
-                'name': 'product.public.category',
-                'tags_method': '_get_category_tags',
-            },
-        ]
-
-        for model in models:
-            invalidate_caches = self.env['invalidate.cache'].search([('res_model', '=', model['name'])])
-            if invalidate_caches:
-                res_ids = invalidate_caches.mapped('res_id')
-                tags = getattr(self, model['tags_method'])(res_ids)
-                self.delete_invalidate_cache(invalidate_caches.ids)
-                self.request_cache_invalidation(url, key, tags)
-                self.env.cr.commit()
+        """
+        Drains the queue, batch by batch. Every endpoint gets its purges at the same time, so a batch lasts as long
+        as the slowest endpoint. The invalidations of an endpoint are removed once its purge succeeded, retried
+        when it failed and dead-lettered after INVALIDATION_MAX_ATTEMPTS attempts, without purging the other
+        endpoints again. The queue is claimed and released with cursors of its own, the transaction of the caller
+        is never committed.
+        """
+        settings = self._get_cache_invalidation_settings()
+        while True:
+            rows = self._claim_invalidate_caches()
+            if not rows:
+                break
+            rows_by_endpoint = {}
+            for row in rows:
+                rows_by_endpoint.setdefault(row[4], {}).setdefault(row[1], []).append(row)
+            targets = self._get_purge_targets(rows_by_endpoint)
+
+            # The tags are read here, the threads only send them
+            tags_by_records = {}
+            jobs = []
+            for endpoint_id, rows_by_model in rows_by_endpoint.items():
+                purges = []
+                for res_model, model_rows in rows_by_model.items():
+                    res_ids = frozenset(row[2] for row in model_rows)
+                    if (res_model, res_ids) not in tags_by_records:
+                        try:
+                            if res_model not in INVALIDATION_TAGS_METHODS:
+                                raise ValueError('No cache tags for the model %s' % res_model)
+                            with self.env.cr.savepoint():
+                                tags = self._get_response_cache_tags(res_model, list(res_ids))
+                            tags_by_records[res_model, res_ids] = (tags, None)
+                        except Exception as e:
+                            _logger.warning('VSF cache tags of %s %s failed: %s', len(res_ids), res_model, e)
+                            tags_by_records[res_model, res_ids] = ([], str(e))
+                    tags, error = tags_by_records[res_model, res_ids]
+                    purges.append((model_rows, tags, error))
+                jobs.append((endpoint_id, targets.get(endpoint_id), purges))
+
+            def purge(job):
+                endpoint_id, target, purges = job
+                start = time.time()
+                results = []
+                for model_rows, tags, error in purges:
+                    # Without target the url of the settings was removed, there is nothing to purge
+                    if target and tags and not error:
+                        url, key, purge_format, chunk_size, tag_prefix = target
+                        try:
+                            send_purge(url, key, [tag_prefix + tag for tag in tags], purge_format, chunk_size,
+                                       settings['concurrency'])
+                        except Exception as e:
+                            _logger.warning('VSF cache invalidation on %s failed: %s', url, e)
+                            error = '%s: %s' % (url, e)
+                    results.append((model_rows, error))
+                return endpoint_id, time.time() - start, results
+
+            with ThreadPoolExecutor(max_workers=min(ENDPOINTS_MAX_WORKERS, len(jobs))) as executor:
+                outcomes = list(executor.map(purge, jobs))
+
+            stats = []
+            for endpoint_id, duration, results in outcomes:
+                for model_rows, error in results:
+                    self._release_invalidate_caches(model_rows, error)
+                if endpoint_id:
+                    errors = [error for model_rows, error in results if error]
+                    stats.append((endpoint_id, duration, '\n'.join(errors) or None))
+            with self.pool.cursor() as cr:
+                self.env(cr=cr)['vsf.cache.endpoint'].sudo()._record_purges(stats)
+
+    def action_retry(self):
+        """ Queues the failed invalidations again """
+        self.write({'state': 'pending', 'attempts': 0, 'next_attempt': False, 'last_error': False})
+        self._notify_invalidation()
 
     def _get_product_tags(self, product_ids):
         tags = ','.join(f'P{product_id}' for product_id in product_ids)
@@ -116,10 +449,27 @@ class InvalidateCache(models.Model):
             tags += ',' + ','.join(f'C{category_id}' for category_id in category_ids)
         return tags
 
-    def _get_category_tags(self, product_ids):
-        tags = ','.join(f'P{product_id}' for product_id in product_ids)
-        category_ids = self.env['product.template'].search(
-            [('id', 'in', product_ids)]).mapped('public_categ_slug_ids').ids
-        if category_ids:
-            tags += ',' + ','.join(f'C{category_id}' for category_id in category_ids)
+    def _get_response_cache_tags(self, res_model, res_ids):
+        """
+        Tags of the GraphQL responses that depend on the records, purged from the response cache and from the
+        endpoints alike. P alone tags the unfiltered product lists.
+        """
+        tags_method = INVALIDATION_TAGS_METHODS.get(res_model)
+        if not res_ids or not tags_method:
+            return []
+        tags = getattr(self, tags_method)(res_ids).split(',')
+        if res_model == 'product.template':
+            tags.insert(0, 'P')
         return tags
+
+    def _get_pricelist_tags(self, pricelist_ids):
+        return ','.join(f'PL{pricelist_id}' for pricelist_id in pricelist_ids)
+
+    def _get_rewrite_tags(self, rewrite_ids):
+        return ','.join(f'WR{rewrite_id}' for rewrite_id in rewrite_ids)
+
+    def _get_menu_tags(self, menu_ids):
+        return ','.join(['WM'] + [f'WM{menu_id}' for menu_id in menu_ids])
+
+    def _get_category_tags(self, category_ids):
+        return ','.join(f'C{category_id}' for category_id in category_ids)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import hashlib
+import logging
+
+from odoo import models, fields, api
+from odoo.tools.lru import LRU
+
+_logger = logging.getLogger(__name__)
+
+# Registered queries of this worker: (database, hash) -> (query, version of the persisted queries)
+QUERIES = LRU(512)
+
+
+class VsfPersistedQuery(models.Model):
+    _name = 'vsf.persisted.query'
+    _description = 'VSF Persisted Query'
+    _order = 'name, id'
+
+    name = fields.Char('Operation Name')
+    sha256_hash = fields.Char('SHA-256 Hash', required=True, readonly=True, compute='_compute_sha256_hash',
+                              store=True, precompute=True)
+    query = fields.Text('Query', required=True)
+
+    _sql_constraints = [
+        ('sha256_hash_uniq', 'unique(sha256_hash)', 'This query is already registered.'),
+    ]
+
+    def init(self):
+        super().init()
+        # Bumped when a query is changed or removed, the queries cached by the workers are then read again
+        self.env.cr.execute("CREATE SEQUENCE IF NOT EXISTS vsf_persisted_query_version;")
+
+    @api.depends('query')
+    def _compute_sha256_hash(self):
+        for persisted_query in self:
+            persisted_query.sha256_hash = hashlib.sha256((persisted_query.query or '').encode('utf-8')).hexdigest()
+
+    def write(self, vals):
+        res = super().write(vals)
+        self._bump_version()
+        return res
+
+    def unlink(self):
+        res = super().unlink()
+        self._bump_version()
+        return res
+
+    @api.model
+    def _bump_version(self):
+        """ A new query is never cached as missing, only the changes and removals invalidate the cached queries """
+        self.env.cr.execute("SELECT nextval('vsf_persisted_query_version');")
+
+    @api.model
+    def _get_query(self, sha256_hash):
+        """ Query text registered for the hash, None if the operation is not registered """
+        cr = self.env.cr
+        cr.execute("SELECT last_value FROM vsf_persisted_query_version;")
+        version = cr.fetchone()[0]
+        key = (cr.dbname, sha256_hash)
+        entry = QUERIES.get(key)
+        if entry and entry[1] == version:
+            return entry[0]
+        cr.execute('SELECT query FROM vsf_persisted_query WHERE sha256_hash = %s', (sha256_hash,))
+        row = cr.fetchone()
+        if not row:
+            return None
+        QUERIES[key] = (row[0], version)
+        return row[0]
+
+    @api.model
+    def _register_query(self, sha256_hash, query, operation_name=None):
+        """ Registers an operation sent by an Automatic Persisted Queries client, concurrent registrations of the
+        same operation are ignored. The visitors can't register more than vsf_persisted_queries_limit queries. """
+        ICP = self.env['ir.config_parameter'].sudo()
+        if not self.env.user._is_internal():
+            limit = int(ICP.get_param('vsf_persisted_queries_limit', 5000))
+            self.env.cr.execute('SELECT count(*) FROM vsf_persisted_query')
+            if self.env.cr.fetchone()[0] >= limit:
+                _logger.warning('Persisted query %s not registered, the limit of %s queries is reached',
+                                sha256_hash, limit)
+                return
+        now = fields.Datetime.now()
+        uid = self.env.uid
+        self.env.cr.execute("""
+            INSERT INTO vsf_persisted_query(name, sha256_hash, query, create_date, write_date, create_uid, write_uid)
+            VALUES(%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (sha256_hash) DO NOTHING;
+        """, (operation_name, sha256_hash, query, now, now, uid, uid))
@@ -3,21 +3,105 @@
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
 import json
+import logging
+import re
+import psycopg2
+from concurrent.futures import ThreadPoolExecutor
 from odoo.osv import expression
 from datetime import timedelta
 from odoo import models, fields, api, tools, _
+from odoo.tools import SQL
 from odoo.tools.float_utils import float_round
 from odoo.addons.http_routing.models.ir_http import slug, slugify
+from odoo.addons.graphql_vuestorefront.models.product_pricelist import price_rule_batch
 from odoo.exceptions import ValidationError
 
+_logger = logging.getLogger(__name__)
+
+# Number of products whose slugs are written with one UPDATE
+SLUG_BATCH_SIZE = 1000
+
+# Number of templates whose variant attribute values are recomputed with one query
+VARIANT_ATTRIBUTE_BATCH_SIZE = 500
+
+# PostgreSQL text search configurations by language, other languages use the `simple` configuration
+TS_CONFIG_BY_LANG = {
+    'ar': 'arabic',
+    'da': 'danish',
+    'de': 'german',
+    'el': 'greek',
+    'en': 'english',
+    'es': 'spanish',
+    'fi': 'finnish',
+    'fr': 'french',
+    'hu': 'hungarian',
+    'id': 'indonesian',
+    'it': 'italian',
+    'lt': 'lithuanian',
+    'nb': 'norwegian',
+    'nl': 'dutch',
+    'pt': 'portuguese',
+    'ro': 'romanian',
+    'ru': 'russian',
+    'sv': 'swedish',
+    'tr': 'turkish',
+}
+
+# Product fields indexed in the text search documents
+SEARCH_DOCUMENT_FIELDS = ['name', 'description_sale', 'default_code']
+
+
+def create_trigram_index(cr, table, column):
+    """
+    Create the index of a translated field with index='trigram', as the ORM would if pg_trgm was installed
+    before the module, so that `ilike` searches on any language of the field can use it.
+    """
+    try:
+        with cr.savepoint(flush=False):
+            cr.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except psycopg2.Error:
+        _logger.warning("Could not create the pg_trgm extension, %s.%s will not have a trigram index", table, column)
+        return
+
+    tools.sql.create_index(
+        cr, tools.sql.make_index_name(table, column), table,
+        ["(jsonb_path_query_array(\"%s\", '$.*')::text) gin_trgm_ops" % column], 'gin')
+
 
 class ProductTemplate(models.Model):
     _inherit = 'product.template'
 
+    def init(self):
+        super().init()
+        cr = self.env.cr
+        if not tools.sql.table_exists(cr, 'product_template_search_document'):
+            cr.execute("""
+                CREATE TABLE product_template_search_document (
+                    product_template_id INTEGER NOT NULL REFERENCES product_template(id) ON DELETE CASCADE,
+                    lang VARCHAR NOT NULL,
+                    document TSVECTOR NOT NULL,
+                    PRIMARY KEY (product_template_id, lang)
+                );
+                CREATE INDEX product_template_search_document_idx
+                ON product_template_search_document USING gin(document);
+            """)
+            self.rebuild_search_documents()
+        create_trigram_index(cr, self._table, 'name')
+        # Templates whose variant attribute values are recomputed in the background
+        cr.execute("""
+            CREATE TABLE IF NOT EXISTS product_template_variant_attribute_queue (
+                product_template_id INTEGER PRIMARY KEY REFERENCES product_template(id) ON DELETE CASCADE,
+                create_date TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() at time zone 'UTC')
+            );
+        """)
+
     @api.model
     def _graphql_get_search_order(self, sort):
         sorting = ''
         for field, val in sort.items():
+            if field == 'relevance':
+                # Not a column, see _graphql_get_search_relevance_order
+                continue
             if sorting:
                 sorting += ', '
             if field == 'price':
@@ -66,9 +150,7 @@ class ProductTemplate(models.Model):
                 domains.append([('name', 'ilike', n)])
 
         if search:
-            for srch in search.split(" "):
-                domains.append([
-                    '|', '|', ('name', 'ilike', srch), ('description_sale', 'like', srch), ('default_code', 'like', srch)])
+            domains.append([('id', 'in', self._graphql_search_document_query(search))])
 
         partial_domain = domains.copy()
 
@@ -111,6 +193,115 @@ class ProductTemplate(models.Model):
 
         return expression.AND(domains), expression.AND(partial_domain)
 
+    @api.model
+    @tools.ormcache('lang')
+    def _get_search_ts_config(self, lang):
+        config = TS_CONFIG_BY_LANG.get((lang or '').split('_')[0], 'simple')
+        self.env.cr.execute("SELECT 1 FROM pg_ts_config WHERE cfgname = %s", (config,))
+        return config if self.env.cr.fetchone() else 'simple'
+
+    @api.model
+    def _get_search_ts_query(self, search):
+        """ Prefix matching of every word of the search, e.g. `blue shir` gives `blue:* & shir:*` """
+        return ' & '.join('%s:*' % term for term in re.findall(r'\w+', search or ''))
+
+    @api.model
+    def _graphql_search_document_query(self, search):
+        """
+        Products matching the search in the name, sales description or internal reference, as a query used as
+        subselect by the domains, so the matching ids are never loaded
+        """
+        ts_query = self._get_search_ts_query(search)
+        if not ts_query:
+            return []
+
+        lang = self.env.lang or 'en_US'
+        query = self.sudo().with_context(active_test=False)._search([])
+        query.add_where(SQL("""
+            EXISTS (
+                SELECT 1
+                FROM product_template_search_document psd
+                WHERE psd.product_template_id = %s AND psd.lang = %s
+                AND psd.document @@ to_tsquery(%s::regconfig, %s)
+            )
+        """, SQL.identifier(query.table, 'id'), lang, self._get_search_ts_config(lang), ts_query))
+        return query
+
+    @api.model
+    def _graphql_get_search_relevance_order(self, search, direction='DESC'):
+        """ ORDER BY expression ranking the products on how well they match the search """
+        lang = self.env.lang or 'en_US'
+        return SQL("""
+            (SELECT ts_rank(psd.document, to_tsquery(%s::regconfig, %s))
+             FROM product_template_search_document psd
+             WHERE psd.product_template_id = "product_template"."id" AND psd.lang = %s) %s NULLS LAST
+        """, self._get_search_ts_config(lang), self._get_search_ts_query(search), lang,
+            SQL('DESC' if direction == 'DESC' else 'ASC'))
+
+    def _update_search_documents(self, langs=None):
+        """ Store the text search documents of the products, one for every installed language or for langs """
+        ids = [product_id for product_id in self.ids if product_id]
+        if not ids:
+            return
+
+        self.flush_model(SEARCH_DOCUMENT_FIELDS)
+        if langs is None:
+            langs = [code for code, name in self.env['res.lang'].get_installed()]
+        configs = [self._get_search_ts_config(lang) for lang in langs]
+
+        self.env.cr.execute("""
+            INSERT INTO product_template_search_document(product_template_id, lang, document)
+            SELECT pt.id, l.code,
+                setweight(to_tsvector(l.config::regconfig, COALESCE(pt.name->>l.code, pt.name->>'en_US', '')), 'A') ||
+                setweight(to_tsvector(l.config::regconfig, COALESCE(pt.default_code, '')), 'A') ||
+                setweight(to_tsvector(l.config::regconfig,
+                                      COALESCE(pt.description_sale->>l.code, pt.description_sale->>'en_US', '')), 'B')
+            FROM product_template pt
+            CROSS JOIN unnest(%s::varchar[], %s::varchar[]) AS l(code, config)
+            WHERE pt.id IN %s
+            ON CONFLICT (product_template_id, lang) DO UPDATE SET document = EXCLUDED.document;
+        """, (langs, configs, tuple(ids)))
+
+    @api.model
+    def rebuild_search_documents(self, batch_size=1000, langs=None):
+        """ Rebuild the text search documents of the whole catalog, for every installed language or for langs """
+        self.env.cr.execute("SELECT id FROM product_template ORDER BY id")
+        ids = [row[0] for row in self.env.cr.fetchall()]
+        for index in range(0, len(ids), batch_size):
+            self.browse(ids[index:index + batch_size])._update_search_documents(langs=langs)
+
+    @api.model
+    def _graphql_get_attribute_value_counts(self, domain, attribute_ids=None):
+        """
+        Facets of the website filters.
+        Returns an ordered dict {attribute value id: number of products} of the visible attribute values
+        available on the products matching the domain, computed with a single aggregate query.
+        """
+        self._flush_search(domain)
+        self.flush_model(['variant_attribute_value_ids'])
+        self.env['product.attribute.value'].flush_model(['attribute_id', 'sequence', 'visibility'])
+
+        query = self._search(domain)
+        if query.is_empty():
+            return {}
+
+        attribute_condition = SQL()
+        if attribute_ids:
+            attribute_condition = SQL("AND pav.attribute_id IN %s", tuple(attribute_ids))
+
+        self.env.cr.execute(SQL("""
+            SELECT rel.product_attribute_value_id, COUNT(*)
+            FROM product_template_variant_product_attribute_value_rel rel
+            JOIN product_attribute_value pav ON pav.id = rel.product_attribute_value_id
+            WHERE rel.product_template_id IN %s
+            AND pav.visibility = 'visible'
+            %s
+            GROUP BY rel.product_attribute_value_id, pav.attribute_id, pav.sequence
+            ORDER BY pav.attribute_id, pav.sequence, rel.product_attribute_value_id;
+        """, query.subselect(), attribute_condition))
+
+        return dict(self.env.cr.fetchall())
+
     def _compute_json_ld(self):
         env = self.env
         website = env['website'].get_current_website()
@@ -151,50 +342,135 @@ class ProductTemplate(models.Model):
 
             product.json_ld = json.dumps(json_ld)
 
-    def _get_public_categ_slug(self, category_ids, category):
-        category_ids.append(category.id)
-
-        if category.parent_id:
-            category_ids = self._get_public_categ_slug(category_ids, category.parent_id)
-
-        return category_ids
+    def _update_public_categ_slug_rel(self, categories_sql):
+        """
+        Replaces the slug categories of the products by the categories given by categories_sql, a query of
+        (product_template_id, product_public_category_id) rows, and all their parents found with parent_path.
+        """
+        cr = self.env.cr
+        cr.execute("""
+            DELETE FROM product_template_product_public_category_slug_rel
+            WHERE product_template_id = ANY(%s);
+        """, (self.ids,))
+        cr.execute(SQL("""
+            INSERT INTO product_template_product_public_category_slug_rel(product_template_id, product_public_category_id)
+            SELECT DISTINCT product_category.product_template_id, parent.id::int
+            FROM (%s) AS product_category(product_template_id, product_public_category_id)
+            JOIN product_public_category category ON category.id = product_category.product_public_category_id
+            CROSS JOIN LATERAL unnest(string_to_array(rtrim(category.parent_path, '/'), '/')) AS parent(id)
+        """, categories_sql))
 
     @api.depends('public_categ_ids')
     def _compute_public_categ_slug_ids(self):
         """ To allow search of website_slug on parent categories """
-        cr = self.env.cr
-
-        for product in self:
-            category_ids = []
-
+        products = self.filtered('id')
+        if not products:
+            return
+        self.env['product.public.category'].flush_model(['parent_path'])
+        product_ids = []
+        category_ids = []
+        for product in products:
             for category in product.public_categ_ids:
-                category_ids = product._get_public_categ_slug(category_ids, category)
-
-            cr.execute("""
-                DELETE FROM product_template_product_public_category_slug_rel
-                WHERE product_template_id=%s;
-            """, (product.id,))
+                product_ids.append(product.id)
+                category_ids.append(category.id)
+        products._update_public_categ_slug_rel(
+            SQL('SELECT * FROM unnest(%s::int[], %s::int[])', product_ids, category_ids))
+
+    def _rebuild_public_categ_slug_rel(self):
+        """ Same as the compute, from the categories of the products stored in the database """
+        self._update_public_categ_slug_rel(SQL("""
+            SELECT product_template_id, product_public_category_id
+            FROM product_public_category_product_template_rel
+            WHERE product_template_id = ANY(%s)
+        """, self.ids))
+        self.invalidate_recordset(['public_categ_slug_ids'], flush=False)
 
-            for category_id in list(dict.fromkeys(category_ids)):
-                cr.execute("""
-                    INSERT INTO product_template_product_public_category_slug_rel(product_template_id, product_public_category_id)
-                    VALUES(%s, %s);
-                """, (product.id, category_id,))
+    @api.model
+    def rebuild_public_categ_slug_ids(self, batch_size=5000, commit=False):
+        """
+        Rebuilds the slug categories of the whole catalog from the database, by batches of products, e.g. after
+        an import or a change of the category tree. Run by its cron or from a shell:
+        env['product.template'].rebuild_public_categ_slug_ids(commit=True)
+        """
+        self.flush_model(['public_categ_ids'])
+        self.env['product.public.category'].flush_model(['parent_path'])
+        self.env.cr.execute("SELECT id FROM product_template ORDER BY id")
+        ids = [row[0] for row in self.env.cr.fetchall()]
+        for index in range(0, len(ids), batch_size):
+            self.browse(ids[index:index + batch_size])._rebuild_public_categ_slug_rel()
+            if commit:
+                self.env.cr.commit()
+            _logger.info('Slug categories rebuilt for %s/%s products', min(index + batch_size, len(ids)), len(ids))
 
     @api.depends('name')
     def _compute_website_slug(self):
-        langs = self.env['res.lang'].search([])
-
         for product in self:
+            if not product.id:
+                product.website_slug = None
+
+        products = self.filtered('id')
+        for index in range(0, len(products), SLUG_BATCH_SIZE):
+            products[index:index + SLUG_BATCH_SIZE]._update_website_slugs()
+
+    def _update_website_slugs(self):
+        """
+        Computes the slugs of all the languages from the stored translations of the names, slugifying each name
+        once, and writes the slugs of all the products with one UPDATE.
+        """
+        if not self:
+            return
+        cr = self.env.cr
+        self.flush_recordset(['name'])
+        langs = {code for code, _name in self.env['res.lang'].get_installed()} | {'en_US'}
+        cr.execute("SELECT id, name FROM product_template WHERE id = ANY(%s)", (self.ids,))
+
+        prefix = '/product'
+        slug_names = {}
+        product_ids = []
+        website_slugs = []
+        for product_id, name in cr.fetchall():
+            name = name or {}
+            website_slug = {}
             for lang in langs:
-                product = product.with_context(lang=lang.code)
+                value = name.get(lang) or name.get('en_US') or ''
+                if value not in slug_names:
+                    slug_names[value] = slugify(value).strip().strip('-')
+                website_slug[lang] = '{}/{}-{}'.format(prefix, slug_names[value], product_id)
+            product_ids.append(product_id)
+            website_slugs.append(json.dumps(website_slug))
+
+        cr.execute("""
+            UPDATE product_template AS product
+            SET website_slug = slug.website_slug::jsonb
+            FROM unnest(%s::int[], %s::text[]) AS slug(id, website_slug)
+            WHERE product.id = slug.id
+        """, (product_ids, website_slugs))
+        self.invalidate_recordset(['website_slug'], flush=False)
 
-                if not product.id:
-                    product.website_slug = None
-                else:
-                    prefix = '/product'
-                    slug_name = slugify(product.name or '').strip().strip('-')
-                    product.website_slug = '{}/{}-{}'.format(prefix, slug_name, product.id)
+    @api.model
+    def regenerate_website_slugs(self, batch_size=SLUG_BATCH_SIZE, workers=4):
+        """
+        Regenerates the slugs of the whole catalog, e.g. after installing a language, by chunks processed in
+        parallel, each one with its own cursor and transaction. From a shell:
+        env['product.template'].regenerate_website_slugs()
+        """
+        self.env.cr.execute("SELECT id FROM product_template ORDER BY id")
+        ids = [row[0] for row in self.env.cr.fetchall()]
+        chunks = [ids[index:index + batch_size] for index in range(0, len(ids), batch_size)]
+        registry = self.pool
+        uid = self.env.uid
+        context = self.env.context
+
+        def regenerate(chunk):
+            with registry.cursor() as cr:
+                env = api.Environment(cr, uid, context)
+                env['product.template'].browse(chunk)._update_website_slugs()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _result in executor.map(regenerate, chunks):
+                pass
+        self.invalidate_model(['website_slug'])
+        _logger.info('Website slugs regenerated for %s products', len(ids))
 
     @api.depends('product_variant_ids')
     def _compute_variant_attribute_value_ids(self):
@@ -204,16 +480,103 @@ class ProductTemplate(models.Model):
         This will ensure that the available attribute values on the website filtering will return results.
         By default, Odoo only shows attributes that will return results but doesn't consider that a particular
         attribute value may not have a variant.
+        The relation is written with SQL, the templates with more variants than the limit are queued and recomputed
+        by the cron.
         """
         for product in self:
-            variants = product.product_variant_ids
-            attribute_values = variants.\
-                mapped('product_template_attribute_value_ids').\
-                mapped('product_attribute_value_id')
-            attribute_values += variants.\
-                mapped('valid_product_template_attribute_line_ids').\
-                mapped('value_ids')
-            product.variant_attribute_value_ids = [(6, 0, attribute_values.ids)]
+            if not product.id:
+                product.variant_attribute_value_ids = [(6, 0, [])]
+
+        products = self.filtered('id')
+        if not products:
+            return
+        products._flush_variant_attribute_values()
+        ICP = self.env['ir.config_parameter'].sudo()
+        self.env.cr.execute("""
+            SELECT product_tmpl_id
+            FROM product_product
+            WHERE active AND product_tmpl_id = ANY(%s)
+            GROUP BY product_tmpl_id
+            HAVING count(*) > %s
+        """, (products.ids, int(ICP.get_param('vsf_variant_attribute_sync_limit', 1000))))
+        queued = self.browse([row[0] for row in self.env.cr.fetchall()])
+        if queued:
+            # Until the cron runs, the stored values are read instead of values cached before the change
+            queued._enqueue_variant_attribute_values()
+            queued.invalidate_recordset(['variant_attribute_value_ids'], flush=False)
+            products -= queued
+        for index in range(0, len(products), VARIANT_ATTRIBUTE_BATCH_SIZE):
+            products[index:index + VARIANT_ATTRIBUTE_BATCH_SIZE]._update_variant_attribute_value_rel()
+
+    def _flush_variant_attribute_values(self):
+        self.env['product.product'].flush_model(['active', 'product_tmpl_id', 'product_template_attribute_value_ids'])
+        self.env['product.template.attribute.value'].flush_model(['product_attribute_value_id'])
+        self.env['product.template.attribute.line'].flush_model(['active', 'product_tmpl_id', 'value_ids'])
+
+    def _update_variant_attribute_value_rel(self):
+        """
+        Replaces the variant attribute values of the templates by the values of the combinations of their active
+        variants and the values of their attribute lines, as the compute did with the ORM.
+        """
+        cr = self.env.cr
+        cr.execute("""
+            DELETE FROM product_template_variant_product_attribute_value_rel
+            WHERE product_template_id = ANY(%s);
+        """, (self.ids,))
+        cr.execute("""
+            INSERT INTO product_template_variant_product_attribute_value_rel(product_template_id,
+                                                                            product_attribute_value_id)
+            SELECT pp.product_tmpl_id, ptav.product_attribute_value_id
+            FROM product_product pp
+            JOIN product_variant_combination pvc ON pvc.product_product_id = pp.id
+            JOIN product_template_attribute_value ptav ON ptav.id = pvc.product_template_attribute_value_id
+            WHERE pp.active AND pp.product_tmpl_id = ANY(%s)
+            UNION
+            SELECT ptal.product_tmpl_id, rel.product_attribute_value_id
+            FROM product_template_attribute_line ptal
+            JOIN product_attribute_value_product_template_attribute_line_rel rel
+                ON rel.product_template_attribute_line_id = ptal.id
+            WHERE ptal.active AND ptal.product_tmpl_id = ANY(%s)
+            AND EXISTS (SELECT 1 FROM product_product pp WHERE pp.active AND pp.product_tmpl_id = ptal.product_tmpl_id)
+        """, (self.ids, self.ids))
+        self.invalidate_recordset(['variant_attribute_value_ids'], flush=False)
+
+    def _enqueue_variant_attribute_values(self):
+        self.env.cr.execute("""
+            INSERT INTO product_template_variant_attribute_queue(product_template_id)
+            SELECT unnest(%s::int[])
+            ON CONFLICT DO NOTHING
+        """, (self.ids,))
+        cron = self.env.ref('graphql_vuestorefront.ir_cron_update_queued_variant_attribute_values',
+                            raise_if_not_found=False)
+        if cron:
+            cron.sudo()._trigger()
+
+    @api.model
+    def update_queued_variant_attribute_values(self, batch_size=VARIANT_ATTRIBUTE_BATCH_SIZE):
+        """ Recomputes the variant attribute values of the queued templates, committing every batch """
+        cr = self.env.cr
+        while True:
+            cr.execute("""
+                DELETE FROM product_template_variant_attribute_queue
+                WHERE product_template_id IN (
+                    SELECT product_template_id
+                    FROM product_template_variant_attribute_queue
+                    ORDER BY create_date
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING product_template_id
+            """, (batch_size,))
+            products = self.browse([row[0] for row in cr.fetchall()])
+            if not products:
+                break
+            products._flush_variant_attribute_values()
+            products._update_variant_attribute_value_rel()
+            # The website filters of the products changed
+            self.env['invalidate.cache'].create_invalidate_cache(self._name, products.ids)
+            cr.commit()
+            _logger.info('Variant attribute values recomputed for %s queued products', len(products))
 
     def _compute_sales_count_30_days(self):
         date_30_days_ago = fields.Datetime.now() - timedelta(days=30)
@@ -236,6 +599,7 @@ class ProductTemplate(models.Model):
             count = sale_count_map.get(product_id, 0)
             product.sales_count_30_days = float_round(count, precision_rounding=product.uom_id.rounding)
 
+    name = fields.Char(index='trigram')
     variant_attribute_value_ids = fields.Many2many('product.attribute.value',
                                                    'product_template_variant_product_attribute_value_rel',
                                                    compute='_compute_variant_attribute_value_ids',
@@ -249,13 +613,31 @@ class ProductTemplate(models.Model):
     sales_count_30_days = fields.Float('Sales Count 30 Days', compute='_compute_sales_count_30_days', store=True,
                                        readonly=True)
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        res = super(ProductTemplate, self).create(vals_list)
+        res._update_search_documents()
+        self.env['invalidate.cache'].create_invalidate_cache(self._name, res.ids)
+        return res
+
     def write(self, vals):
+        if 'name' in vals:
+            # The slugs are computed from the name
+            self.env['vsf.tombstone'].create_tombstones(self)
+        categories = self.public_categ_slug_ids if 'public_categ_ids' in vals else None
         res = super(ProductTemplate, self).write(vals)
+        if any(field in vals for field in SEARCH_DOCUMENT_FIELDS):
+            self._update_search_documents()
         self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        if categories:
+            # The tags of the products only cover their new categories, the lists of the old ones changed too
+            self.env['invalidate.cache'].create_invalidate_cache(
+                'product.public.category', (categories - self.public_categ_slug_ids).ids)
         return res
 
     def unlink(self):
         self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        self.env['vsf.tombstone'].create_tombstones(self)
         return super(ProductTemplate, self).unlink()
 
     def _get_combination_info(self, combination=False, product_id=False, add_qty=1, parent_combination=False,
@@ -286,6 +668,20 @@ class ProductTemplate(models.Model):
 class ProductProduct(models.Model):
     _inherit = 'product.product'
 
+    def write(self, vals):
+        res = super(ProductProduct, self).write(vals)
+        if 'default_code' in vals:
+            self.product_tmpl_id._update_search_documents()
+        return res
+
+    def _get_combination_info_variant_batch(self, add_qty=1):
+        """
+        Returns {product id: _get_combination_info_variant()} for the whole recordset. The pricelist rules, currency
+        rates and tax mappings are computed once for all the products instead of product by product.
+        """
+        with price_rule_batch(self.product_tmpl_id, self):
+            return {product.id: product._get_combination_info_variant(add_qty=add_qty) for product in self}
+
     def _compute_json_ld(self):
         env = self.env
         website = env['website'].get_current_website()
@@ -330,6 +726,10 @@ class ProductProduct(models.Model):
 class ProductPublicCategory(models.Model):
     _inherit = 'product.public.category'
 
+    def init(self):
+        super().init()
+        create_trigram_index(self.env.cr, self._table, 'name')
+
     def _compute_json_ld(self):
         website = self.env['website'].get_current_website()
         base_url = website.domain or ''
@@ -354,6 +754,7 @@ class ProductPublicCategory(models.Model):
             if self.search([('website_slug', '=', category.website_slug), ('id', '!=', category.id)], limit=1):
                 raise ValidationError(_('Slug is already in use: {}'.format(category.website_slug)))
 
+    name = fields.Char(index='trigram')
     website_slug = fields.Char('Website Slug', translate=True, copy=False)
     attribute_ids = fields.Many2many('product.attribute', string='Filtering Attributes')
 
@@ -367,17 +768,28 @@ class ProductPublicCategory(models.Model):
             else:
                 rec.website_slug = '/category/{}'.format(rec.id)
 
+        self.env['invalidate.cache'].create_invalidate_cache(self._name, res.ids)
         return res
 
     def write(self, vals):
+        if 'website_slug' in vals:
+            self.env['vsf.tombstone'].create_tombstones(self)
         res = super(ProductPublicCategory, self).write(vals)
         if vals.get('website_slug', False):
             self._validate_website_slug()
+        if 'parent_id' in vals:
+            # The parents of the categories changed for all the products of the subtree
+            self.flush_model(['parent_path'])
+            self.env['product.template'].flush_model(['public_categ_ids'])
+            products = self.env['product.template'].with_context(active_test=False).search(
+                [('public_categ_ids', 'child_of', self.ids)])
+            products._rebuild_public_categ_slug_rel()
         self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
         return res
 
     def unlink(self):
         self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        self.env['vsf.tombstone'].create_tombstones(self)
         return super(ProductPublicCategory, self).unlink()
 
 
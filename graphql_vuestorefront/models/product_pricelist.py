@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import contextlib
+
+from odoo import models, api
+from odoo.http import request
+
+
+class PriceRuleBatch(object):
+    """ Pricelist rules, currency rates and tax mappings of the products of a batch, computed once """
+
+    def __init__(self, templates, products):
+        self.product_ids = {
+            'product.template': set(templates.ids),
+            'product.product': set(products.ids),
+        }
+        self.prices = {}
+        self.rates = {}
+        self.taxes = {}
+
+
+def get_price_rule_batch():
+    """ The price rule batch of the current http request, if any """
+    if not request:
+        return None
+    return getattr(request, 'vsf_price_rule_batch', None)
+
+
+@contextlib.contextmanager
+def price_rule_batch(templates, products):
+    """ Prices the products of templates and products as a batch until the block exits, see PriceRuleBatch """
+    if not request:
+        yield None
+        return
+    previous = getattr(request, 'vsf_price_rule_batch', None)
+    request.vsf_price_rule_batch = batch = PriceRuleBatch(templates, products)
+    try:
+        yield batch
+    finally:
+        request.vsf_price_rule_batch = previous
+
+
+class ProductPricelist(models.Model):
+    _inherit = 'product.pricelist'
+
+    def write(self, vals):
+        res = super(ProductPricelist, self).write(vals)
+        self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        return res
+
+    def unlink(self):
+        self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        return super(ProductPricelist, self).unlink()
+
+    def _compute_price_rule(self, products, quantity, currency=None, uom=None, date=False, compute_price=True,
+                            **kwargs):
+        """
+        Inside a price rule batch (see price_rule_batch) the rules are computed for all the products of the batch
+        on the first call, the following calls with the same arguments use those results.
+        """
+        batch = get_price_rule_batch()
+        if not batch or not products or products._name not in batch.product_ids:
+            return super(ProductPricelist, self)._compute_price_rule(
+                products, quantity, currency=currency, uom=uom, date=date, compute_price=compute_price, **kwargs)
+
+        key = (self.id, self.env.company.id, products._name, quantity, currency and currency.id, uom and uom.id, date, compute_price,
+               tuple(sorted(kwargs.items())))
+        try:
+            prices = batch.prices.setdefault(key, {})
+        except TypeError:
+            # Unhashable arguments, can't be batched
+            return super(ProductPricelist, self)._compute_price_rule(
+                products, quantity, currency=currency, uom=uom, date=date, compute_price=compute_price, **kwargs)
+
+        if any(product_id not in prices for product_id in products.ids):
+            batch_products = (products.browse(batch.product_ids[products._name]) | products).filtered(
+                lambda p: p.id not in prices)
+            prices.update(super(ProductPricelist, self)._compute_price_rule(
+                batch_products, quantity, currency=currency, uom=uom, date=date, compute_price=compute_price,
+                **kwargs))
+
+        return {product_id: prices[product_id] for product_id in products.ids}
+
+
+class ProductPricelistItem(models.Model):
+    _inherit = 'product.pricelist.item'
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        res = super(ProductPricelistItem, self).create(vals_list)
+        self.env['invalidate.cache'].create_invalidate_cache('product.pricelist', res.pricelist_id.ids)
+        return res
+
+    def write(self, vals):
+        pricelists = self.pricelist_id
+        res = super(ProductPricelistItem, self).write(vals)
+        self.env['invalidate.cache'].create_invalidate_cache('product.pricelist', (pricelists | self.pricelist_id).ids)
+        return res
+
+    def unlink(self):
+        self.env['invalidate.cache'].create_invalidate_cache('product.pricelist', self.pricelist_id.ids)
+        return super(ProductPricelistItem, self).unlink()
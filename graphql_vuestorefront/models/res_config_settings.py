@@ -12,6 +12,10 @@ class ResConfigSettings(models.TransientModel):
     _inherit = 'res.config.settings'
 
     vsf_debug_mode = fields.Boolean('Debug Mode')
+    vsf_persisted_queries_strict = fields.Boolean('Only Persisted Queries')
+    vsf_response_cache = fields.Boolean('Response Cache')
+    vsf_response_cache_shared = fields.Boolean('Shared Response Cache')
+    vsf_response_cache_ttl = fields.Integer('Response Cache TTL (s)')
     vsf_payment_success_return_url = fields.Char(
         'Payment Success Return Url', related='website_id.vsf_payment_success_return_url', readonly=False,
         required=True
@@ -23,6 +27,9 @@ class ResConfigSettings(models.TransientModel):
     vsf_cache_invalidation = fields.Boolean('Cache Invalidation')
     vsf_cache_invalidation_key = fields.Char('Cache Invalidation Key', required=True)
     vsf_cache_invalidation_url = fields.Char('Cache Invalidation Url', required=True)
+    vsf_cache_invalidation_debounce = fields.Integer('Cache Invalidation Debounce (ms)')
+    vsf_cache_invalidation_chunk_size = fields.Integer('Cache Invalidation Tags per Request')
+    vsf_cache_invalidation_concurrency = fields.Integer('Cache Invalidation Concurrent Requests')
     vsf_mailing_list_id = fields.Many2one('mailing.list', 'Newsletter', domain=[('is_public', '=', True)],
                                           related='website_id.vsf_mailing_list_id', readonly=False, required=True)
     reset_password_email_template_id = fields.Many2one('mail.template', string='Reset Password',
@@ -41,9 +48,16 @@ class ResConfigSettings(models.TransientModel):
         ICP = self.env['ir.config_parameter'].sudo()
         res.update(
             vsf_debug_mode=ICP.get_param('vsf_debug_mode'),
+            vsf_persisted_queries_strict=ICP.get_param('vsf_persisted_queries_strict'),
+            vsf_response_cache=ICP.get_param('vsf_response_cache'),
+            vsf_response_cache_shared=ICP.get_param('vsf_response_cache_shared'),
+            vsf_response_cache_ttl=int(ICP.get_param('vsf_response_cache_ttl', 3600)),
             vsf_cache_invalidation=ICP.get_param('vsf_cache_invalidation'),
             vsf_cache_invalidation_key=ICP.get_param('vsf_cache_invalidation_key'),
             vsf_cache_invalidation_url=ICP.get_param('vsf_cache_invalidation_url'),
+            vsf_cache_invalidation_debounce=int(ICP.get_param('vsf_cache_invalidation_debounce', 500)),
+            vsf_cache_invalidation_chunk_size=int(ICP.get_param('vsf_cache_invalidation_chunk_size', 500)),
+            vsf_cache_invalidation_concurrency=int(ICP.get_param('vsf_cache_invalidation_concurrency', 4)),
             vsf_image_quality=int(ICP.get_param('vsf_image_quality', 100)),
             vsf_image_background_rgba=ICP.get_param('vsf_image_background_rgba', '(255, 255, 255, 255)'),
             vsf_image_resize_limit=int(ICP.get_param('vsf_image_resize_limit', 1920)),
@@ -57,12 +71,28 @@ class ResConfigSettings(models.TransientModel):
         if self.vsf_image_resize_limit < 0:
             raise ValidationError(_('Invalid image resize limit.'))
 
+        if self.vsf_response_cache_ttl < 0:
+            raise ValidationError(_('Invalid response cache TTL.'))
+
+        if self.vsf_cache_invalidation_debounce < 0:
+            raise ValidationError(_('Invalid cache invalidation debounce.'))
+
+        if self.vsf_cache_invalidation_chunk_size < 1 or self.vsf_cache_invalidation_concurrency < 1:
+            raise ValidationError(_('Invalid cache invalidation tags per request or concurrent requests.'))
+
         super(ResConfigSettings, self).set_values()
         ICP = self.env['ir.config_parameter'].sudo()
         ICP.set_param('vsf_debug_mode', self.vsf_debug_mode)
+        ICP.set_param('vsf_persisted_queries_strict', self.vsf_persisted_queries_strict)
+        ICP.set_param('vsf_response_cache', self.vsf_response_cache)
+        ICP.set_param('vsf_response_cache_shared', self.vsf_response_cache_shared)
+        ICP.set_param('vsf_response_cache_ttl', self.vsf_response_cache_ttl)
         ICP.set_param('vsf_cache_invalidation', self.vsf_cache_invalidation)
         ICP.set_param('vsf_cache_invalidation_key', self.vsf_cache_invalidation_key)
         ICP.set_param('vsf_cache_invalidation_url', self.vsf_cache_invalidation_url)
+        ICP.set_param('vsf_cache_invalidation_debounce', self.vsf_cache_invalidation_debounce)
+        ICP.set_param('vsf_cache_invalidation_chunk_size', self.vsf_cache_invalidation_chunk_size)
+        ICP.set_param('vsf_cache_invalidation_concurrency', self.vsf_cache_invalidation_concurrency)
         ICP.set_param('vsf_image_quality', self.vsf_image_quality)
         ICP.set_param('vsf_image_background_rgba', self.vsf_image_background_rgba)
         ICP.set_param('vsf_image_resize_limit', self.vsf_image_resize_limit)
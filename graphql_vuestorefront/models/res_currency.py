@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+from odoo import models, api
+from odoo.addons.graphql_vuestorefront.models.product_pricelist import get_price_rule_batch
+
+
+class ResCurrency(models.Model):
+    _inherit = 'res.currency'
+
+    def _get_rates(self, company, date):
+        """ Inside a price rule batch the rates are read once for all the products """
+        batch = get_price_rule_batch()
+        if not batch:
+            return super(ResCurrency, self)._get_rates(company, date)
+
+        key = (tuple(self.ids), company.id, date)
+        if key not in batch.rates:
+            batch.rates[key] = super(ResCurrency, self)._get_rates(company, date)
+        return batch.rates[key]
+
+
+class ResCurrencyRate(models.Model):
+    _inherit = 'res.currency.rate'
+
+    def _invalidate_vsf_prices(self, currencies):
+        """ The prices of the pricelists in the currencies are converted with the rates """
+        self.env['invalidate.cache'].bump_catalog_version()
+        pricelists = self.env['product.pricelist'].sudo().with_context(active_test=False).search([
+            ('currency_id', 'in', currencies.ids),
+        ])
+        self.env['invalidate.cache'].create_invalidate_cache('product.pricelist', pricelists.ids)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        res = super(ResCurrencyRate, self).create(vals_list)
+        self._invalidate_vsf_prices(res.currency_id)
+        return res
+
+    def write(self, vals):
+        currencies = self.currency_id
+        res = super(ResCurrencyRate, self).write(vals)
+        self._invalidate_vsf_prices(currencies | self.currency_id)
+        return res
+
+    def unlink(self):
+        self._invalidate_vsf_prices(self.currency_id)
+        return super(ResCurrencyRate, self).unlink()
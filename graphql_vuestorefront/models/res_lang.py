@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+from odoo import models, api
+
+
+class ResLang(models.Model):
+    _inherit = 'res.lang'
+
+    def _update_vsf_search_documents(self):
+        """ The products are only searched in the languages they have a search document for """
+        langs = self.filtered('active').mapped('code')
+        if langs:
+            self.env['product.template'].sudo().rebuild_search_documents(langs=langs)
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        res = super(ResLang, self).create(vals_list)
+        res._update_vsf_search_documents()
+        return res
+
+    def write(self, vals):
+        activated = self.filtered(lambda lang: not lang.active) if vals.get('active') else self.browse()
+        res = super(ResLang, self).write(vals)
+        activated._update_vsf_search_documents()
+        return res
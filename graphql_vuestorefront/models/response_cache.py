@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import logging
+import time
+
+import psycopg2
+from odoo import models, api
+from odoo.tools.lru import LRU
+
+_logger = logging.getLogger(__name__)
+
+# Responses cached by this worker: key -> (body, tag versions, timestamp)
+MEMORY_CACHE = LRU(2048)
+
+
+class VsfResponseCache(models.AbstractModel):
+    _name = 'vsf.response.cache'
+    _description = 'VSF GraphQL Response Cache'
+
+    def init(self):
+        super().init()
+        cr = self.env.cr
+        # Version of every tag, bumped when a tagged record changes. A response is valid as long as the versions of
+        # its tags did not change since it was stored, whichever worker stored it.
+        cr.execute("""
+            CREATE TABLE IF NOT EXISTS vsf_cache_tag (
+                tag VARCHAR PRIMARY KEY,
+                version BIGINT NOT NULL DEFAULT 0
+            );
+        """)
+        # Shared tier, seen by every worker
+        cr.execute("""
+            CREATE TABLE IF NOT EXISTS vsf_response_cache (
+                key VARCHAR PRIMARY KEY,
+                body TEXT NOT NULL,
+                tags VARCHAR[] NOT NULL,
+                tag_versions BIGINT[] NOT NULL,
+                create_date TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() at time zone 'UTC')
+            );
+            CREATE INDEX IF NOT EXISTS vsf_response_cache_tags_idx ON vsf_response_cache USING gin (tags);
+        """)
+
+    @api.model
+    def _is_enabled(self):
+        ICP = self.env['ir.config_parameter'].sudo()
+        return bool(ICP.get_param('vsf_response_cache', False))
+
+    @api.model
+    def _get_tag_versions(self, tags):
+        if not tags:
+            return {}
+        self.env.cr.execute('SELECT tag, version FROM vsf_cache_tag WHERE tag = ANY(%s)', (list(tags),))
+        versions = dict.fromkeys(tags, 0)
+        versions.update(self.env.cr.fetchall())
+        return versions
+
+    @api.model
+    def _get_ttl(self):
+        ICP = self.env['ir.config_parameter'].sudo()
+        return int(ICP.get_param('vsf_response_cache_ttl', 3600))
+
+    @api.model
+    def _is_shared(self):
+        ICP = self.env['ir.config_parameter'].sudo()
+        return bool(ICP.get_param('vsf_response_cache_shared', False))
+
+    @api.model
+    def _get(self, key):
+        """ Body and tags of the cached response, None if it's missing, expired or one of its tags was invalidated """
+        ttl = self._get_ttl()
+        entry = MEMORY_CACHE.get(key)
+        if entry is None and self._is_shared():
+            self.env.cr.execute("""
+                SELECT body, tags, tag_versions, extract(epoch from create_date at time zone 'UTC')
+                FROM vsf_response_cache
+                WHERE key = %s
+            """, (key,))
+            row = self.env.cr.fetchone()
+            if row:
+                entry = (row[0], dict(zip(row[1], row[2])), float(row[3]))
+                MEMORY_CACHE[key] = entry
+        if entry is None:
+            return None
+
+        body, tag_versions, timestamp = entry
+        if time.time() - timestamp > ttl or self._get_tag_versions(tag_versions) != tag_versions:
+            MEMORY_CACHE.pop(key, None)
+            return None
+        return body, set(tag_versions)
+
+    @api.model
+    def _set(self, key, body, tags):
+        # Read in the same snapshot than the data of the response, a change committed meanwhile bumped the versions
+        tag_versions = self._get_tag_versions(tags)
+        timestamp = time.time()
+        MEMORY_CACHE[key] = (body, tag_versions, timestamp)
+        if self._is_shared():
+            try:
+                with self.env.cr.savepoint(flush=False):
+                    self.env.cr.execute("""
+                        INSERT INTO vsf_response_cache(key, body, tags, tag_versions, create_date)
+                        VALUES(%s, %s, %s, %s, to_timestamp(%s) at time zone 'UTC')
+                        ON CONFLICT (key) DO UPDATE
+                        SET body = EXCLUDED.body, tags = EXCLUDED.tags, tag_versions = EXCLUDED.tag_versions,
+                            create_date = EXCLUDED.create_date;
+                    """, (key, body, list(tag_versions), list(tag_versions.values()), timestamp))
+            except psycopg2.Error as e:
+                # Another worker is storing the same response
+                _logger.debug('VSF response cache not shared: %s', e)
+
+    @api.model
+    def _invalidate_tags(self, tags):
+        """
+        Evicts the responses tagged with any of the tags, in every worker, once the transaction is committed.
+        The versions are bumped in a short transaction of their own, so the writers don't hold the locks of the
+        shared tags (P, WM) until their commit. A response computed meanwhile was stored with the previous
+        versions and is evicted as well.
+        """
+        if not tags:
+            return
+        postcommit = self.env.cr.postcommit
+        pending_tags = postcommit.data.get('vsf_response_cache_tags')
+        if pending_tags is not None:
+            pending_tags.update(tags)
+            return
+        pending_tags = postcommit.data['vsf_response_cache_tags'] = set(tags)
+        registry = self.pool
+
+        @postcommit.add
+        def invalidate_after_commit():
+            # Sorted, the concurrent invalidations lock the tags in the same order
+            tags = sorted(pending_tags)
+            with registry.cursor() as cr:
+                cr.execute("""
+                    INSERT INTO vsf_cache_tag(tag, version)
+                    SELECT unnest(%s::varchar[]), 1
+                    ON CONFLICT (tag) DO UPDATE SET version = vsf_cache_tag.version + 1;
+                """, (tags,))
+                cr.execute('DELETE FROM vsf_response_cache WHERE tags && %s::varchar[]', (tags,))
+
+    @api.model
+    def gc_response_cache(self):
+        """ Removes the expired responses of the shared tier """
+        self.env.cr.execute("""
+            DELETE FROM vsf_response_cache
+            WHERE create_date < (now() at time zone 'UTC') - make_interval(secs => %s)
+        """, (self._get_ttl(),))
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+from datetime import timedelta
+
+from odoo import models, fields, api
+from odoo.tools import SQL
+
+
+class VsfTombstone(models.Model):
+    _name = 'vsf.tombstone'
+    _description = 'VSF Tombstone'
+    _order = 'id'
+
+    res_model = fields.Char('Res Model', required=True)
+    res_id = fields.Integer('Res ID', required=True)
+    website_slug = fields.Char('Website Slug', translate=True)
+
+    def init(self):
+        super().init()
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS vsf_tombstone_res_model_create_date_idx
+            ON vsf_tombstone(res_model, create_date);
+        """)
+
+    @api.model
+    def create_tombstones(self, records, slug_sql=None):
+        """
+        Logs the current slugs of the records, before they are removed or replaced, for the delta endpoints.
+        slug_sql is the translated JSONB value of the slug, the website_slug column by default.
+        """
+        if not records:
+            return
+        records.flush_recordset()
+        # Same date as the write date of the records, the start of the transaction
+        now = self.env.cr.now()
+        self.env.cr.execute(SQL("""
+            INSERT INTO vsf_tombstone(res_model, res_id, website_slug, create_date, write_date, create_uid, write_uid)
+            SELECT %s, id, %s, %s, %s, %s, %s
+            FROM %s
+            WHERE id IN %s
+        """, records._name, slug_sql or SQL.identifier('website_slug'), now, now, self.env.uid, self.env.uid,
+            SQL.identifier(records._table), tuple(records.ids)))
+
+    @api.model
+    def get_retention_date(self):
+        """ Deltas since an older date are incomplete, the tombstones are removed after the retention """
+        ICP = self.env['ir.config_parameter'].sudo()
+        days = int(ICP.get_param('vsf_tombstone_retention_days', 30))
+        return fields.Datetime.now() - timedelta(days=days)
+
+    @api.model
+    def gc_tombstones(self):
+        self.env.cr.execute('DELETE FROM vsf_tombstone WHERE create_date < %s', (self.get_retention_date(),))
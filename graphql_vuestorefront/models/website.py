@@ -3,8 +3,12 @@
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 import pprint
 import json
-import requests
 from odoo import models, fields, api
+from odoo.tools import SQL
+
+# Lookup structure of the redirect map of every database in this worker, see
+# WebsiteRewrite._vsf_get_redirect_lookup
+REDIRECT_LOOKUP = {}
 
 
 class WebsiteSeoMetadata(models.AbstractModel):
@@ -126,33 +130,122 @@ class Website(models.Model):
 class WebsiteRewrite(models.Model):
     _inherit = 'website.rewrite'
 
+    def init(self):
+        super().init()
+        # Compiled redirect map, a single row
+        self.env.cr.execute("""
+            CREATE TABLE IF NOT EXISTS vsf_redirect_map (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version BIGINT NOT NULL,
+                body TEXT NOT NULL
+            );
+        """)
+
     def _get_vsf_tags(self):
         tags = 'WR%s' % self.id
         return tags
 
-    def _vsf_request_cache_invalidation(self):
-        ICP = self.env['ir.config_parameter'].sudo()
-        url = ICP.get_param('vsf_cache_invalidation_url', False)
-        key = ICP.get_param('vsf_cache_invalidation_key', False)
+    def _vsf_invalidate_caches(self):
+        """ Purges the rewrites through the invalidation queue and compiles the redirect map again """
+        self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        self._vsf_compile_redirect_map()
 
-        if url and key:
-            try:
-                for website_rewrite in self:
-                    tags = website_rewrite._get_vsf_tags()
+    @api.model
+    def _vsf_compile_redirect_map(self):
+        """ Stores the redirects as one JSON blob, served as is by /vsf/redirects, with a new version """
+        rewrites = self.sudo().search_fetch([], ['url_from', 'url_to', 'redirect_type'])
+        redirect_map = [
+            {'from': rewrite.url_from, 'to': rewrite.url_to, 'type': rewrite.redirect_type} for rewrite in rewrites
+        ]
+        self.env.cr.execute("""
+            INSERT INTO vsf_redirect_map(id, version, body)
+            VALUES (1, 1, %s)
+            ON CONFLICT (id) DO UPDATE SET version = vsf_redirect_map.version + 1, body = EXCLUDED.body
+            RETURNING version
+        """, (json.dumps(redirect_map),))
+        return self.env.cr.fetchone()[0]
 
-                    # Make the GET request to the /cache-invalidate
-                    requests.get(url, params={'key': key, 'tags': tags}, timeout=5)
-            except:
-                pass
+    @api.model
+    def _vsf_get_redirect_map_version(self):
+        """ Version of the redirect map, 0 if it was never compiled """
+        self.env.cr.execute("SELECT version FROM vsf_redirect_map")
+        row = self.env.cr.fetchone()
+        return row[0] if row else 0
+
+    @api.model
+    def _vsf_get_redirect_map(self):
+        """ Version and JSON blob of the redirect map, compiled the first time """
+        self.env.cr.execute("SELECT version, body FROM vsf_redirect_map")
+        row = self.env.cr.fetchone()
+        if not row:
+            self._vsf_compile_redirect_map()
+            return self._vsf_get_redirect_map()
+        return row
+
+    @api.model
+    def _vsf_get_redirect_lookup(self):
+        """
+        Lookup structure of the redirect map, built once per version in each worker: the redirects by exact
+        source and the prefix redirects, whose source ends with /*, by prefix.
+        """
+        dbname = self.env.cr.dbname
+        version = self._vsf_get_redirect_map_version()
+        lookup = REDIRECT_LOOKUP.get(dbname)
+        if not lookup or lookup['version'] != version:
+            version, redirect_map = self._vsf_get_redirect_map()
+            lookup = {'version': version, 'exact': {}, 'prefixes': {}}
+            for redirect in json.loads(redirect_map):
+                if redirect['from'].endswith('/*'):
+                    lookup['prefixes'].setdefault(redirect['from'][:-2], redirect)
+                else:
+                    lookup['exact'].setdefault(redirect['from'], redirect)
+            REDIRECT_LOOKUP[dbname] = lookup
+        return lookup
+
+    @api.model
+    def vsf_resolve_redirect(self, path):
+        """
+        Redirect of the path: the exact redirect, else the prefix redirect of its longest parent. The target of a
+        prefix redirect ending with /* gets the rest of the path.
+        """
+        lookup = self._vsf_get_redirect_lookup()
+        redirect = lookup['exact'].get(path)
+        if redirect:
+            return redirect
+
+        prefix = path.rstrip('/')
+        while prefix:
+            prefix = prefix.rpartition('/')[0]
+            redirect = lookup['prefixes'].get(prefix)
+            if redirect:
+                url_to = redirect['to']
+                if url_to.endswith('/*'):
+                    url_to = url_to[:-2] + path[len(prefix):]
+                return dict(redirect, to=url_to)
+        return None
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        rewrites = super(WebsiteRewrite, self).create(vals_list)
+        rewrites._vsf_invalidate_caches()
+        return rewrites
+
+    def _vsf_create_tombstones(self):
+        self.env['vsf.tombstone'].create_tombstones(self, SQL("jsonb_build_object('en_US', url_from)"))
 
     def write(self, vals):
+        if 'url_from' in vals:
+            self._vsf_create_tombstones()
         res = super(WebsiteRewrite, self).write(vals)
-        self._vsf_request_cache_invalidation()
+        self._vsf_invalidate_caches()
         return res
 
     def unlink(self):
-        self._vsf_request_cache_invalidation()
-        return super(WebsiteRewrite, self).unlink()
+        self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        self._vsf_create_tombstones()
+        res = super(WebsiteRewrite, self).unlink()
+        self._vsf_compile_redirect_map()
+        return res
 
 
 class WebsiteMenu(models.Model):
@@ -162,6 +255,21 @@ class WebsiteMenu(models.Model):
     menu_image_ids = fields.One2many('website.menu.image', 'menu_id', string='Menu Images')
     is_mega_menu = fields.Boolean(store=True)
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        menus = super(WebsiteMenu, self).create(vals_list)
+        self.env['invalidate.cache'].create_invalidate_cache(self._name, menus.ids)
+        return menus
+
+    def write(self, vals):
+        res = super(WebsiteMenu, self).write(vals)
+        self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        return res
+
+    def unlink(self):
+        self.env['invalidate.cache'].create_invalidate_cache(self._name, self.ids)
+        return super(WebsiteMenu, self).unlink()
+
 
 class WebsiteMenuImage(models.Model):
     _name = 'website.menu.image'
@@ -180,3 +288,19 @@ class WebsiteMenuImage(models.Model):
     text_color = fields.Char('Text Color (Hex)', help='#111000')
     button_text = fields.Char('Button Text')
     button_url = fields.Char('Button URL')
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        images = super(WebsiteMenuImage, self).create(vals_list)
+        self.env['invalidate.cache'].create_invalidate_cache('website.menu', images.menu_id.ids)
+        return images
+
+    def write(self, vals):
+        menu_ids = self.menu_id.ids
+        res = super(WebsiteMenuImage, self).write(vals)
+        self.env['invalidate.cache'].create_invalidate_cache('website.menu', list(set(menu_ids + self.menu_id.ids)))
+        return res
+
+    def unlink(self):
+        self.env['invalidate.cache'].create_invalidate_cache('website.menu', self.menu_id.ids)
+        return super(WebsiteMenuImage, self).unlink()
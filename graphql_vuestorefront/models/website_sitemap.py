@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import gzip
+import io
+import json
+import logging
+from xml.sax.saxutils import escape
+
+from odoo import models, api
+from odoo.tools import SQL
+
+_logger = logging.getLogger(__name__)
+
+SITEMAP_MAX_URLS = 50000
+SITEMAP_CHUNK_SIZE = 5000
+SITEMAP_INDEX_NAME = 'vsf-sitemap-{website}.xml'
+SITEMAP_SHARD_NAME = 'vsf-sitemap-{website}-{lang}-{entity}-{shard}.xml.gz'
+
+# Entities of the sitemap: table and condition of the records with a page on the storefront
+SITEMAP_ENTITIES = {
+    'products': ('product_template', SQL('is_published AND active')),
+    'categories': ('product_public_category', SQL('TRUE')),
+}
+
+
+class Website(models.Model):
+    _inherit = 'website'
+
+    def _get_vsf_sitemap_base_url(self, lang):
+        base_url = (self.domain or '').rstrip('/')
+        if lang != self.default_lang_id:
+            base_url += '/' + lang.url_code
+        return base_url
+
+    def _get_vsf_sitemap_condition(self, entity, lang):
+        table, condition = SITEMAP_ENTITIES[entity]
+        return SQL(
+            "%s AND (website_id IS NULL OR website_id = %s) "
+            "AND COALESCE(website_slug->>%s, website_slug->>'en_US', '') != ''",
+            condition, self.id, lang.code)
+
+    def _get_vsf_sitemap_fingerprints(self, entity, lang):
+        """
+        Fingerprint of every shard of the entity: number of urls, range of ids and last write date. A shard is
+        generated again only when its fingerprint changes.
+        """
+        table, condition = SITEMAP_ENTITIES[entity]
+        self.env.cr.execute(SQL("""
+            SELECT shard, count(*), min(id), max(id), max(write_date)
+            FROM (
+                SELECT id, write_date, (row_number() OVER (ORDER BY id) - 1) / %s AS shard
+                FROM %s
+                WHERE %s
+            ) urls
+            GROUP BY shard
+            ORDER BY shard
+        """, SITEMAP_MAX_URLS, SQL.identifier(table), self._get_vsf_sitemap_condition(entity, lang)))
+        return [
+            (shard, [count, min_id, max_id, str(write_date)])
+            for shard, count, min_id, max_id, write_date in self.env.cr.fetchall()
+        ]
+
+    def _render_vsf_sitemap_shard(self, entity, lang, min_id, max_id):
+        """ Gzipped urlset of the records between the ids, read by chunks """
+        table, condition = SITEMAP_ENTITIES[entity]
+        base_url = self._get_vsf_sitemap_base_url(lang)
+        buffer = io.BytesIO()
+        # No modification time, the same urls give the same file
+        with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as sitemap:
+            sitemap.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+                          b'<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+            last_id = min_id - 1
+            while last_id < max_id:
+                self.env.cr.execute(SQL("""
+                    SELECT id, COALESCE(website_slug->>%s, website_slug->>'en_US'), write_date
+                    FROM %s
+                    WHERE %s AND id > %s AND id <= %s
+                    ORDER BY id
+                    LIMIT %s
+                """, lang.code, SQL.identifier(table), self._get_vsf_sitemap_condition(entity, lang), last_id,
+                    max_id, SITEMAP_CHUNK_SIZE))
+                rows = self.env.cr.fetchall()
+                if not rows:
+                    break
+                sitemap.write(''.join(
+                    '<url><loc>%s</loc><lastmod>%s</lastmod></url>\n' % (
+                        escape(base_url + slug), write_date.date().isoformat())
+                    for record_id, slug, write_date in rows
+                ).encode('utf-8'))
+                last_id = rows[-1][0]
+            sitemap.write(b'</urlset>\n')
+        return buffer.getvalue()
+
+    def _render_vsf_sitemap_index(self, shards):
+        base_url = (self.domain or '').rstrip('/')
+        sitemaps = ''.join(
+            '<sitemap><loc>%s/vsf/sitemap/%s</loc><lastmod>%s</lastmod></sitemap>\n' % (
+                escape(base_url), escape(shard.name), shard.write_date.date().isoformat())
+            for shard in shards
+        )
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+                '%s</sitemapindex>\n' % sitemaps).encode('utf-8')
+
+    def _get_vsf_sitemap_attachments(self, prefix):
+        return self.env['ir.attachment'].sudo().search([
+            ('res_model', '=', 'website'),
+            ('res_id', '=', self.id),
+            ('name', '=like', prefix + '%'),
+        ])
+
+    def _save_vsf_sitemap(self, attachment, name, mimetype, raw, fingerprint=None):
+        vals = {
+            'raw': raw,
+            'description': fingerprint and json.dumps(fingerprint),
+        }
+        if attachment:
+            attachment.write(vals)
+            return attachment
+        return self.env['ir.attachment'].sudo().create(dict(
+            vals, name=name, mimetype=mimetype, res_model='website', res_id=self.id, public=True))
+
+    def _generate_vsf_sitemap(self):
+        """ Generates the shards whose urls changed, then the index if any shard changed """
+        self.ensure_one()
+        attachments = self._get_vsf_sitemap_attachments('vsf-sitemap-%s-' % self.id)
+        attachments_by_name = {attachment.name: attachment for attachment in attachments}
+        shards = self.env['ir.attachment']
+        changed = False
+        for lang in self.language_ids:
+            for entity in SITEMAP_ENTITIES:
+                for shard, fingerprint in self._get_vsf_sitemap_fingerprints(entity, lang):
+                    name = SITEMAP_SHARD_NAME.format(website=self.id, lang=lang.url_code, entity=entity, shard=shard)
+                    attachment = attachments_by_name.pop(name, None)
+                    if not attachment or attachment.description != json.dumps(fingerprint):
+                        count, min_id, max_id, write_date = fingerprint
+                        raw = self._render_vsf_sitemap_shard(entity, lang, min_id, max_id)
+                        attachment = self._save_vsf_sitemap(attachment, name, 'application/gzip', raw, fingerprint)
+                        changed = True
+                    shards |= attachment
+
+        # Shards of the removed languages and of the urls that no longer fill them
+        obsolete = self.env['ir.attachment'].sudo().union(*attachments_by_name.values())
+        if obsolete:
+            obsolete.unlink()
+            changed = True
+
+        index_name = SITEMAP_INDEX_NAME.format(website=self.id)
+        index = self._get_vsf_sitemap_attachments(index_name)
+        if changed or not index:
+            self._save_vsf_sitemap(index[:1], index_name, 'application/xml', self._render_vsf_sitemap_index(shards))
+            _logger.info('VSF sitemap of website %s generated with %s shards', self.id, len(shards))
+
+    @api.model
+    def generate_vsf_sitemaps(self):
+        for website in self.search([('domain', '!=', False)]):
+            website._generate_vsf_sitemap()
+            self.env.cr.commit()
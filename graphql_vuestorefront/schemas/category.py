@@ -4,6 +4,7 @@
 
 import graphene
 
+from odoo.addons.graphql_vuestorefront.schemas.loaders import prefetch_selection
 from odoo.addons.graphql_vuestorefront.schemas.objects import (
     SortEnum, Category
 )
@@ -101,4 +102,5 @@ class CategoryQuery(graphene.ObjectType):
         total_count = ProductPublicCategory.search_count(domain)
         categories = ProductPublicCategory.search(
             domain, limit=page_size, offset=offset, order=order)
+        prefetch_selection(info, categories, 'categories')
         return CategoryList(categories=categories, total_count=total_count)
@@ -7,10 +7,12 @@ from graphql import GraphQLError
 from odoo.http import request
 from odoo import _
 
+from odoo.addons.graphql_vuestorefront.schemas.loaders import prefetch_selection, is_field_selected
 from odoo.addons.graphql_vuestorefront.schemas.objects import (
     SortEnum, Invoice,
     get_document_with_check_access,
-    get_document_count_with_check_access
+    get_document_count_with_check_access,
+    get_keyset_domain, get_keyset_first, get_keyset_page
 )
 
 
@@ -40,6 +42,8 @@ class InvoiceSortInput(graphene.InputObjectType):
 class Invoices(graphene.Interface):
     invoices = graphene.List(Invoice)
     total_count = graphene.Int(required=True)
+    end_cursor = graphene.String()
+    has_next_page = graphene.Boolean()
 
 
 class InvoiceList(graphene.ObjectType):
@@ -57,7 +61,9 @@ class InvoiceQuery(graphene.ObjectType):
         Invoices,
         current_page=graphene.Int(default_value=1),
         page_size=graphene.Int(default_value=10),
-        sort=graphene.Argument(InvoiceSortInput, default_value={})
+        sort=graphene.Argument(InvoiceSortInput, default_value={}),
+        after=graphene.String(default_value=None, description='Cursor mode: end cursor of the previous page'),
+        first=graphene.Int(default_value=None, description='Cursor mode: number of invoices to return')
     )
 
     @staticmethod
@@ -70,7 +76,7 @@ class InvoiceQuery(graphene.ObjectType):
         return invoice.sudo()
 
     @staticmethod
-    def resolve_invoices(self, info, current_page, page_size, sort):
+    def resolve_invoices(self, info, current_page, page_size, sort, after=None, first=None):
         env = info.context["env"]
         user = request.env.user
         partner = user.partner_id
@@ -86,7 +92,22 @@ class InvoiceQuery(graphene.ObjectType):
             offset = 0
 
         AccountMove = env["account.move"]
-        invoices = get_document_with_check_access(AccountMove, domain, sort_order, page_size, offset,
-                                                  error_msg='Invoice does not exist.')
-        total_count = get_document_count_with_check_access(AccountMove, domain)
-        return InvoiceList(invoices=invoices and invoices.sudo() or invoices, total_count=total_count)
+        end_cursor = None
+        has_next_page = None
+        if first is not None or after:
+            # Cursor mode, the page starts right after the last invoice of the previous one
+            first = get_keyset_first(first, page_size)
+            keyset_domain = domain + get_keyset_domain(sort_order, after)
+            invoices = get_document_with_check_access(AccountMove, keyset_domain, sort_order, first + 1,
+                                                      error_msg='Invoice does not exist.')
+            invoices, end_cursor, has_next_page = get_keyset_page(invoices, first, sort_order)
+        else:
+            invoices = get_document_with_check_access(AccountMove, domain, sort_order, page_size, offset,
+                                                      error_msg='Invoice does not exist.')
+        total_count = 0
+        if is_field_selected(info, 'total_count'):
+            total_count = get_document_count_with_check_access(AccountMove, domain)
+        invoices = invoices and invoices.sudo() or invoices
+        prefetch_selection(info, invoices, 'invoices')
+        return InvoiceList(invoices=invoices, total_count=total_count,
+                           end_cursor=end_cursor, has_next_page=has_next_page)
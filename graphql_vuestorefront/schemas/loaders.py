@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# Copyright 2024 ERPGAP/PROMPTEQUATION LDA
+# License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
+
+import itertools
+
+from graphene.utils.str_converters import to_snake_case
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode, OperationType
+from odoo.http import request
+from odoo.models import PREFETCH_MAX
+
+PRODUCT_SELECTION_FIELDS = {
+    'type_id': ['detailed_type'],
+    'visibility': ['is_published'],
+    'sku': ['default_code'],
+    'description': ['description_sale'],
+    'currency': ['currency_id'],
+    'meta_title': ['website_meta_title'],
+    'meta_keyword': ['website_meta_keywords'],
+    'meta_description': ['website_meta_description'],
+    'image_filename': ['name'],
+    'categories': ['public_categ_ids'],
+    'allow_out_of_stock': ['allow_out_of_stock_order'],
+    'show_available_qty': ['show_availability'],
+    'ribbon': ['website_ribbon_id'],
+    'media_gallery': ['product_template_image_ids', 'product_variant_image_ids'],
+    'slug': ['website_slug'],
+    'alternative_products': ['alternative_product_ids'],
+    'accessory_products': ['accessory_product_ids'],
+    'variant_attribute_values': ['product_template_attribute_value_ids'],
+    'product_template': ['product_tmpl_id'],
+    'price': ['list_price'],
+    'attribute_values': ['attribute_line_ids'],
+    'product_variants': ['product_variant_ids'],
+    'first_variant': ['product_variant_ids'],
+}
+
+# ORM fields read by the resolvers of the GraphQL fields, GraphQL fields that are not listed here are read from
+# the ORM field of the same name
+SELECTION_FIELDS = {
+    'product.template': PRODUCT_SELECTION_FIELDS,
+    'product.product': PRODUCT_SELECTION_FIELDS,
+    'product.public.category': {
+        'image_filename': ['name'],
+        'parent': ['parent_id'],
+        'childs': ['child_id'],
+        'slug': ['website_slug'],
+        'products': ['product_tmpl_ids'],
+        'meta_title': ['website_meta_title'],
+        'meta_keyword': ['website_meta_keywords'],
+        'meta_description': ['website_meta_description'],
+    },
+    'sale.order': {
+        'partner': ['partner_id'],
+        'partner_shipping': ['partner_shipping_id'],
+        'partner_invoice': ['partner_invoice_id'],
+        'shipping_method': ['carrier_id'],
+        'currency': ['currency_id'],
+        'order_lines': ['order_line'],
+        'stage': ['state'],
+        'transactions': ['transaction_ids'],
+        'last_transaction': ['transaction_ids'],
+        'coupons': ['applied_coupon_ids'],
+        'gift_cards': ['applied_coupon_ids'],
+    },
+    'account.move': {
+        'partner': ['partner_id'],
+        'partner_shipping': ['partner_shipping_id'],
+        'currency': ['currency_id'],
+        'invoice_lines': ['invoice_line_ids'],
+        'transactions': ['transaction_ids'],
+    },
+}
+
+
+class RelationLoader(object):
+    """
+    Loads a relational field for every sibling record of a GraphQL level at once.
+
+    The siblings of a record are the records prefetched with it, e.g. the page of products returned by a search.
+    On the first record of a level the field is fetched for all the siblings with one query, the optional filter
+    is applied once on all the related records, and the other records of the level are served from the loader.
+    The related records are themselves prefetched together, so the next level is batched the same way.
+    """
+
+    def __init__(self, field_name, filter_func=None):
+        self.field_name = field_name
+        self.filter_func = filter_func
+        self.values = {}
+        self.prefetch_ids = ()
+
+    def _load(self, record):
+        sibling_ids = [
+            record_id for record_id in itertools.islice(record._prefetch_ids, PREFETCH_MAX)
+            if record_id not in self.values
+        ]
+        siblings = record.browse(sibling_ids) | record
+        if siblings._fields[self.field_name].store:
+            siblings.fetch([self.field_name])
+
+        related = siblings.mapped(self.field_name)
+        if self.filter_func:
+            related = self.filter_func(related)
+        related_ids = set(related.ids)
+
+        for sibling in siblings:
+            self.values[sibling.id] = [
+                related_id for related_id in sibling[self.field_name]._ids if related_id in related_ids
+            ]
+        self.prefetch_ids = tuple(dict.fromkeys(self.prefetch_ids + tuple(related.ids)))
+
+    def load(self, record):
+        if record.id not in self.values:
+            self._load(record)
+        comodel = record.env[record._fields[self.field_name].comodel_name]
+        return comodel.browse(self.values[record.id]).with_prefetch(self.prefetch_ids)
+
+
+def get_request_loaders(info):
+    """
+    Loaders are shared by every resolver of the request. Mutations change the records, so they don't use any.
+    """
+    if not request or info.operation.operation == OperationType.MUTATION:
+        return None
+    loaders = getattr(request, 'vsf_loaders', None)
+    if loaders is None:
+        loaders = request.vsf_loaders = {}
+    return loaders
+
+
+def load_relation(info, record, field_name, filter_func=None, key=None):
+    """
+    Same as record[field_name], optionally filtered by filter_func(related records), but batched with the
+    sibling records. The key identifies the filter of the loader. Records of different users, or with and without
+    superuser mode, have loaders of their own: the related records they can read differ.
+    """
+    loaders = get_request_loaders(info)
+    if loaders is None or not record.id:
+        value = record[field_name]
+        return filter_func(value) if filter_func else value
+
+    loader_key = (record._name, field_name, key, record.env.uid, record.env.su)
+    if loader_key not in loaders:
+        loaders[loader_key] = RelationLoader(field_name, filter_func)
+    return loaders[loader_key].load(record)
+
+
+def load_current_wishlist(info, env):
+    """ Wishlist of the current visitor, searched once per request """
+    loaders = get_request_loaders(info)
+    if loaders is None:
+        return env['product.wishlist'].current()
+    if 'wishlist' not in loaders:
+        loaders['wishlist'] = env['product.wishlist'].current()
+    return loaders['wishlist']
+
+
+def _get_child_selection_sets(info, selection_set, field_name):
+    """ Selection sets of the field_name fields selected in selection_set, None for a scalar field """
+    for selection in selection_set.selections if selection_set else []:
+        if isinstance(selection, FieldNode):
+            if to_snake_case(selection.name.value) == field_name:
+                yield selection.selection_set
+        elif isinstance(selection, InlineFragmentNode):
+            yield from _get_child_selection_sets(info, selection.selection_set, field_name)
+        elif isinstance(selection, FragmentSpreadNode):
+            fragment = info.fragments.get(selection.name.value)
+            if fragment:
+                yield from _get_child_selection_sets(info, fragment.selection_set, field_name)
+
+
+def is_field_selected(info, field_name):
+    """ Whether the field_name field is selected under the current field, e.g. the total count of a list """
+    return any(
+        True
+        for field_node in info.field_nodes
+        for selection_set in _get_child_selection_sets(info, field_node.selection_set, field_name)
+    )
+
+
+def get_selected_fields(info, field_name):
+    """
+    Names, in snake case, of the GraphQL fields selected under the field_name field of the current field, e.g. the
+    fields asked for every product of the products query. Fragments are followed.
+    """
+    def collect(selection_set, names):
+        for selection in selection_set.selections if selection_set else []:
+            if isinstance(selection, FieldNode):
+                names.add(to_snake_case(selection.name.value))
+            elif isinstance(selection, InlineFragmentNode):
+                collect(selection.selection_set, names)
+            elif isinstance(selection, FragmentSpreadNode):
+                fragment = info.fragments.get(selection.name.value)
+                if fragment:
+                    collect(fragment.selection_set, names)
+
+    selected = set()
+    for field_node in info.field_nodes:
+        for selection_set in _get_child_selection_sets(info, field_node.selection_set, field_name):
+            collect(selection_set, selected)
+    return selected
+
+
+def prefetch_selection(info, records, field_name):
+    """
+    Reads, with one query for the whole page, only the stored ORM fields needed by the GraphQL fields selected
+    under field_name, instead of letting the first resolver prefetch every column of the model.
+    """
+    if not records:
+        return records
+    mapping = SELECTION_FIELDS.get(records._name, {})
+    fnames = []
+    for name in get_selected_fields(info, field_name):
+        for fname in mapping.get(name, [name]):
+            field = records._fields.get(fname)
+            if not field or not field.store or fname in fnames:
+                continue
+            if field.groups and not records.env.su and not records.user_has_groups(field.groups):
+                continue
+            fnames.append(fname)
+    if fnames:
+        records.fetch(fnames)
+    return records
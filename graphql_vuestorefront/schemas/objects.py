@@ -2,17 +2,26 @@
 # Copyright 2024 ERPGAP/PROMPTEQUATION LDA
 # License LGPL-3.0 or later (http://www.gnu.org/licenses/lgpl).
 
+import base64
+import itertools
+import json
+
 import graphene
 from graphene.types import generic
 from graphql import GraphQLError
-from odoo import SUPERUSER_ID, _
+from odoo import SUPERUSER_ID, fields, _
 
 from odoo.addons.http_routing.models.ir_http import slugify
 from odoo.addons.graphql_base import OdooObjectType
 from odoo.exceptions import AccessError
+from odoo.models import PREFETCH_MAX
+from odoo.osv import expression
 from odoo.http import request
 from odoo.addons.auth_totp.controllers.home import TRUSTED_DEVICE_COOKIE
+from odoo.addons.graphql_vuestorefront.schemas.loaders import load_relation, load_current_wishlist
 
+# Cursor pages are loaded in one query, their size is capped
+KEYSET_MAX_FIRST = 200
 
 # --------------------- #
 #       ENUMS           #
@@ -75,12 +84,157 @@ def get_document_count_with_check_access(model, domain):
     return model.search_count(domain)
 
 
+def get_search_order_terms(order):
+    """ Split an order like `list_price DESC, id ASC` in a list of (field, direction) """
+    terms = []
+    for term in order.split(','):
+        term = term.strip().split()
+        field = term[0]
+        direction = len(term) > 1 and term[1].upper() or 'ASC'
+        if field not in [t[0] for t in terms]:
+            terms.append((field, direction))
+    return terms
+
+
+def encode_cursor(record, order):
+    """ Opaque cursor with the values of the order fields of the record """
+    values = []
+    for field_name, direction in get_search_order_terms(order):
+        field = record._fields[field_name]
+        if field.type == 'datetime':
+            # Read the value from the database, the cache doesn't keep microseconds
+            record.env.cr.execute('SELECT "%s" FROM "%s" WHERE id = %%s' % (field_name, record._table), (record.id,))
+            value = record.env.cr.fetchone()[0]
+            value = value and value.isoformat(' ')
+        elif field.type == 'date':
+            value = fields.Date.to_string(record[field_name])
+        else:
+            value = record[field_name]
+        values.append(value)
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except ValueError:
+        raise GraphQLError(_('Invalid cursor.'))
+
+
+def get_keyset_domain(order, cursor):
+    """
+    Domain of the records placed after the cursor, following the order.
+    Null values follow PostgreSQL's default ordering, last when ascending and first when descending.
+    """
+    if not cursor:
+        return []
+
+    terms = get_search_order_terms(order)
+    values = decode_cursor(cursor)
+    if not isinstance(values, list) or len(values) != len(terms):
+        raise GraphQLError(_('Invalid cursor.'))
+
+    domains = []
+    for index, (field_name, direction) in enumerate(terms):
+        value = values[index]
+        if direction == 'DESC':
+            after = [(field_name, '!=', False)] if value is None else [(field_name, '<', value)]
+        elif value is None:
+            continue
+        else:
+            after = ['|', (field_name, '>', value), (field_name, '=', False)]
+
+        equals = [[(f, '=', v if v is not None else False)] for (f, d), v in zip(terms[:index], values)]
+        domains.append(expression.AND(equals + [after]))
+
+    return expression.OR(domains) if domains else expression.FALSE_DOMAIN
+
+
+def get_keyset_first(first, page_size):
+    """ Number of records of a cursor page, page_size by default, at most KEYSET_MAX_FIRST """
+    if first is None:
+        first = page_size
+    if first < 1:
+        raise GraphQLError(_('The number of records to return must be positive.'))
+    return min(first, KEYSET_MAX_FIRST)
+
+
+def get_keyset_page(records, first, order):
+    """ Expects first + 1 records to know if there is a next page """
+    has_next_page = len(records) > first
+    records = records[:first]
+    end_cursor = records and encode_cursor(records[-1], order) or None
+    return records, end_cursor, has_next_page
+
+
+class PricingMemo(object):
+    """ Pricing information computed during one GraphQL request, with hit/miss counters for debugging """
+
+    def __init__(self):
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, product):
+        website = product.env['website'].get_current_website()
+        pricelist_id = website._get_current_pricelist().id
+
+        def get_key(product_id):
+            return product._name, product_id, pricelist_id, 1
+
+        if get_key(product.id) in self.values:
+            self.hits += 1
+        elif product._name != 'product.product':
+            self.misses += 1
+            self.values[get_key(product.id)] = product._get_combination_info_variant()
+        else:
+            self.misses += 1
+            # Price the whole list the product belongs to (its prefetched siblings) in a single batch
+            sibling_ids = [
+                product_id for product_id in itertools.islice(product._prefetch_ids, PREFETCH_MAX)
+                if get_key(product_id) not in self.values
+            ]
+            siblings = product.browse(sibling_ids) | product
+            for product_id, pricing_info in siblings._get_combination_info_variant_batch().items():
+                self.values[get_key(product_id)] = pricing_info
+
+        # Resolvers change the returned dict, the memo must keep its own copy
+        return dict(self.values[get_key(product.id)])
+
+
+def get_pricing_memo():
+    """ The memo is stored on the http request so that it is shared by every resolver of the request """
+    if not request:
+        return None
+    memo = getattr(request, 'vsf_pricing_memo', None)
+    if memo is None:
+        memo = request.vsf_pricing_memo = PricingMemo()
+    return memo
+
+
 def get_product_pricing_info(product):
-    return product and product._get_combination_info_variant() or None
+    if not product:
+        return None
+    memo = get_pricing_memo()
+    if memo is None:
+        return product._get_combination_info_variant()
+    return memo.get(product)
 
 
-def product_is_in_wishlist(env, product):
-    return product._is_in_wishlist()
+def product_is_in_wishlist(env, product, wishlist=None):
+    if wishlist is None:
+        return product._is_in_wishlist()
+    if product._name == 'product.template':
+        return product in wishlist.mapped('product_id.product_tmpl_id')
+    return product in wishlist.mapped('product_id')
+
+
+def filter_website_categories(categories):
+    """ Categories available on the current website """
+    website = categories.env['website'].get_current_website()
+    if website:
+        return categories.filtered(lambda c: not c.website_id or c.website_id.id == website.id)
+    return categories
 
 
 # --------------------- #
@@ -303,16 +457,16 @@ class Category(OdooObjectType):
         return slugify(self.name)
 
     def resolve_parent(self, info):
-        return self.parent_id or None
+        return load_relation(info, self, 'parent_id') or None
 
     def resolve_childs(self, info):
-        return self.child_id or None
+        return load_relation(info, self, 'child_id') or None
 
     def resolve_slug(self, info):
         return self.website_slug
 
     def resolve_products(self, info):
-        return self.product_tmpl_ids or None
+        return load_relation(info, self, 'product_tmpl_ids') or None
 
     def resolve_meta_title(self, info):
         return self.website_meta_title or None
@@ -335,6 +489,7 @@ class AttributeValue(OdooObjectType):
     search = graphene.String()
     price_extra = graphene.Float(description='Not use in the return Attributes List of the Products Query')
     attribute = graphene.Field(lambda: Attribute)
+    product_count = graphene.Int(description='Only used in the return Attributes List of the Products Query')
 
     def resolve_id(self, info):
         return self.id or None
@@ -347,6 +502,9 @@ class AttributeValue(OdooObjectType):
     def resolve_attribute(self, info):
         return self.attribute_id or None
 
+    def resolve_product_count(self, info):
+        return self.env.context.get('vsf_attribute_value_counts', {}).get(self.id)
+
 
 class Attribute(OdooObjectType):
     id = graphene.Int(required=True)
@@ -471,7 +629,7 @@ class Product(OdooObjectType):
         return self.description_sale or None
 
     def resolve_currency(self, info):
-        return self.currency_id or None
+        return load_relation(info, self, 'currency_id') or None
 
     def resolve_meta_title(self, info):
         return self.website_meta_title or None
@@ -498,11 +656,7 @@ class Product(OdooObjectType):
         return '/web/image/{}/{}/image_512'.format(self._name, self.id)
 
     def resolve_categories(self, info):
-        website = self.env['website'].get_current_website()
-        if website:
-            return self.public_categ_ids.filtered(
-                lambda c: not c.website_id or c.website_id and c.website_id.id == website.id) or None
-        return self.public_categ_ids or None
+        return load_relation(info, self, 'public_categ_ids', filter_website_categories, key='website') or None
 
     def resolve_allow_out_of_stock(self, info):
         return self.allow_out_of_stock_order or None
@@ -511,21 +665,22 @@ class Product(OdooObjectType):
         return self.show_availability or None
 
     def resolve_ribbon(self, info):
-        return self.website_ribbon_id or None
+        return load_relation(info, self, 'website_ribbon_id') or None
 
     def resolve_is_in_stock(self, info):
         return bool(self.free_qty > 0)
 
     def resolve_is_in_wishlist(self, info):
         env = info.context["env"]
-        is_in_wishlist = product_is_in_wishlist(env, self)
+        is_in_wishlist = product_is_in_wishlist(env, self, load_current_wishlist(info, env))
         return bool(is_in_wishlist)
 
     def resolve_media_gallery(self, info):
         if self._name == 'product.template':
-            return self.product_template_image_ids or None
+            return load_relation(info, self, 'product_template_image_ids') or None
         else:
-            return self.product_template_image_ids + self.product_variant_image_ids or None
+            return load_relation(info, self, 'product_template_image_ids') + \
+                load_relation(info, self, 'product_variant_image_ids') or None
 
     def resolve_qty(self, info):
         return self.free_qty
@@ -534,10 +689,10 @@ class Product(OdooObjectType):
         return self.website_slug
 
     def resolve_alternative_products(self, info):
-        return self.alternative_product_ids or None
+        return load_relation(info, self, 'alternative_product_ids') or None
 
     def resolve_accessory_products(self, info):
-        return self.accessory_product_ids or None
+        return load_relation(info, self, 'accessory_product_ids') or None
 
     # Specific to use in Product Variant
     def resolve_combination_info_variant(self, info):
@@ -631,6 +786,19 @@ class Product(OdooObjectType):
         return self.product_variant_id or None
 
 
+class ProductSuggestion(OdooObjectType):
+    id = graphene.Int(required=True)
+    name = graphene.String()
+    slug = graphene.String()
+    thumbnail = graphene.String()
+
+    def resolve_slug(self, info):
+        return self.website_slug
+
+    def resolve_thumbnail(self, info):
+        return '/web/image/{}/{}/image_512'.format(self._name, self.id)
+
+
 class Payment(OdooObjectType):
     id = graphene.Int()
     name = graphene.String()
@@ -680,7 +848,7 @@ class OrderLine(OdooObjectType):
     coupon = graphene.Field(lambda: Coupon)
 
     def resolve_product(self, info):
-        return self.product_id or None
+        return load_relation(info, self, 'product_id') or None
 
     def resolve_quantity(self, info):
         return self.product_uom_qty or None
@@ -756,13 +924,13 @@ class Order(OdooObjectType):
     report_order_line = graphene.List(graphene.NonNull(lambda: OrderLine))
 
     def resolve_partner(self, info):
-        return self.partner_id or None
+        return load_relation(info, self, 'partner_id') or None
 
     def resolve_partner_shipping(self, info):
-        return self.partner_shipping_id or None
+        return load_relation(info, self, 'partner_shipping_id') or None
 
     def resolve_partner_invoice(self, info):
-        return self.partner_invoice_id or None
+        return load_relation(info, self, 'partner_invoice_id') or None
 
     def resolve_date_order(self, info):
         return self.date_order or None
@@ -771,13 +939,13 @@ class Order(OdooObjectType):
         return self.tax_totals or None
 
     def resolve_shipping_method(self, info):
-        return self.carrier_id or None
+        return load_relation(info, self, 'carrier_id') or None
 
     def resolve_currency(self, info):
-        return self.currency_id or None
+        return load_relation(info, self, 'currency_id') or None
 
     def resolve_order_lines(self, info):
-        return self.order_line or None
+        return load_relation(info, self, 'order_line') or None
 
     def resolve_website_order_line(self, info):
         return self.website_order_line.filtered(lambda l: l.id and l.product_id) or None
@@ -789,7 +957,7 @@ class Order(OdooObjectType):
         return self.get_portal_url() or None
 
     def resolve_transactions(self, info):
-        return self.transaction_ids or None
+        return load_relation(info, self, 'transaction_ids') or None
 
     def resolve_last_transaction(self, info):
         if self.transaction_ids:
@@ -834,7 +1002,7 @@ class InvoiceLine(OdooObjectType):
     price_total = graphene.Float()
 
     def resolve_product(self, info):
-        return self.product_id or None
+        return load_relation(info, self, 'product_id') or None
 
 
 class Invoice(OdooObjectType):
@@ -856,10 +1024,10 @@ class Invoice(OdooObjectType):
     transactions = graphene.List(graphene.NonNull(lambda: PaymentTransaction))
 
     def resolve_partner(self, info):
-        return self.partner_id or None
+        return load_relation(info, self, 'partner_id') or None
 
     def resolve_partner_shipping(self, info):
-        return self.partner_shipping_id or None
+        return load_relation(info, self, 'partner_shipping_id') or None
 
     def resolve_invoice_date(self, info):
         return self.invoice_date or None
@@ -871,10 +1039,10 @@ class Invoice(OdooObjectType):
         return self.tax_totals or None
 
     def resolve_currency(self, info):
-        return self.currency_id or None
+        return load_relation(info, self, 'currency_id') or None
 
     def resolve_invoice_lines(self, info):
-        return self.invoice_line_ids or None
+        return load_relation(info, self, 'invoice_line_ids') or None
 
     def resolve_state(self, info):
         return self.state or None
@@ -883,7 +1051,7 @@ class Invoice(OdooObjectType):
         return self.get_portal_url() or None
 
     def resolve_transactions(self, info):
-        return self.transaction_ids or None
+        return load_relation(info, self, 'transaction_ids') or None
 
 
 class WishlistItem(OdooObjectType):
@@ -892,10 +1060,10 @@ class WishlistItem(OdooObjectType):
     product = graphene.Field(lambda: Product)
 
     def resolve_partner(self, info):
-        return self.partner_id or None
+        return load_relation(info, self, 'partner_id') or None
 
     def resolve_product(self, info):
-        return self.product_id or None
+        return load_relation(info, self, 'product_id') or None
 
 
 class PaymentMethod(OdooObjectType):
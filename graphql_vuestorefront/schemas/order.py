@@ -7,10 +7,12 @@ from graphql import GraphQLError
 from odoo.http import request
 from odoo import _
 
+from odoo.addons.graphql_vuestorefront.schemas.loaders import prefetch_selection, is_field_selected
 from odoo.addons.graphql_vuestorefront.schemas.objects import (
     SortEnum, OrderStage, InvoiceStatus, Order, ShippingMethod,
     get_document_with_check_access,
-    get_document_count_with_check_access
+    get_document_count_with_check_access,
+    get_keyset_domain, get_keyset_first, get_keyset_page
 )
 
 
@@ -45,6 +47,8 @@ class OrderSortInput(graphene.InputObjectType):
 class Orders(graphene.Interface):
     orders = graphene.List(Order)
     total_count = graphene.Int(required=True)
+    end_cursor = graphene.String()
+    has_next_page = graphene.Boolean()
 
 
 class OrderList(graphene.ObjectType):
@@ -63,7 +67,9 @@ class OrderQuery(graphene.ObjectType):
         filter=graphene.Argument(OrderFilterInput, default_value={}),
         current_page=graphene.Int(default_value=1),
         page_size=graphene.Int(default_value=10),
-        sort=graphene.Argument(OrderSortInput, default_value={})
+        sort=graphene.Argument(OrderSortInput, default_value={}),
+        after=graphene.String(default_value=None, description='Cursor mode: end cursor of the previous page'),
+        first=graphene.Int(default_value=None, description='Cursor mode: number of orders to return')
     )
     delivery_methods = graphene.List(
         graphene.NonNull(ShippingMethod)
@@ -79,7 +85,7 @@ class OrderQuery(graphene.ObjectType):
         return order.sudo()
 
     @staticmethod
-    def resolve_orders(self, info, filter, current_page, page_size, sort):
+    def resolve_orders(self, info, filter, current_page, page_size, sort, after=None, first=None):
         env = info.context["env"]
         user = request.env.user
         partner = user.partner_id
@@ -107,10 +113,25 @@ class OrderQuery(graphene.ObjectType):
             offset = 0
 
         SaleOrder = env["sale.order"]
-        orders = get_document_with_check_access(SaleOrder, domain, sort_order, page_size, offset,
-                                                error_msg='Sale Order does not exist.')
-        total_count = get_document_count_with_check_access(SaleOrder, domain)
-        return OrderList(orders=orders and orders.sudo() or orders, total_count=total_count)
+        end_cursor = None
+        has_next_page = None
+        if first is not None or after:
+            # Cursor mode, the page starts right after the last sale order of the previous one
+            first = get_keyset_first(first, page_size)
+            keyset_domain = domain + get_keyset_domain(sort_order, after)
+            orders = get_document_with_check_access(SaleOrder, keyset_domain, sort_order, first + 1,
+                                                    error_msg='Sale Order does not exist.')
+            orders, end_cursor, has_next_page = get_keyset_page(orders, first, sort_order)
+        else:
+            orders = get_document_with_check_access(SaleOrder, domain, sort_order, page_size, offset,
+                                                    error_msg='Sale Order does not exist.')
+        total_count = 0
+        if is_field_selected(info, 'total_count'):
+            total_count = get_document_count_with_check_access(SaleOrder, domain)
+        orders = orders and orders.sudo() or orders
+        prefetch_selection(info, orders, 'orders')
+        return OrderList(orders=orders, total_count=total_count,
+                         end_cursor=end_cursor, has_next_page=has_next_page)
 
     @staticmethod
     def resolve_delivery_methods(self, info):
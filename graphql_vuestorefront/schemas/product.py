@@ -5,12 +5,17 @@
 import graphene
 from graphql import GraphQLError
 from odoo import _
+from odoo.osv import expression
+from odoo.tools import SQL, escape_psql
+from odoo.addons.graphql_vuestorefront.schemas.loaders import prefetch_selection, is_field_selected
 from odoo.addons.graphql_vuestorefront.schemas.objects import (
-    SortEnum, Product, Attribute, AttributeValue
+    SortEnum, Product, Attribute, AttributeValue, ProductSuggestion,
+    get_keyset_domain, get_keyset_first, get_keyset_page
 )
 
 
-def get_product_list(env, current_page, page_size, search, sort, **kwargs):
+def get_product_list(env, current_page, page_size, search, sort, after=None, first=None, with_count=True,
+                     **kwargs):
     Product = env['product.template'].sudo()
     Category = env['product.public.category'].sudo()
     domain, partial_domain = Product._graphql_get_search_domain(search, **kwargs)
@@ -21,51 +26,48 @@ def get_product_list(env, current_page, page_size, search, sort, **kwargs):
     else:
         offset = 0
     order = Product._graphql_get_search_order(sort)
-    products = Product.search(domain, order=order)
 
-    # Attempt to get attribute values from category, otherwise fallback to attribute values from products
-    attribute_values = env['product.attribute.value'].sudo()
+    # Only the requested page is loaded, the total is counted by the database
+    end_cursor = None
+    has_next_page = None
+    if first is not None or after:
+        # Cursor mode, the page starts right after the last product of the previous one
+        first = get_keyset_first(first, page_size)
+        products = Product.search(domain + get_keyset_domain(order, after), order=order, limit=first + 1)
+        products, end_cursor, has_next_page = get_keyset_page(products, first, order)
+    elif search and sort.get('relevance'):
+        # Best matches of the text search first, the other sort fields break the ties
+        query = Product._search(domain, offset=offset, limit=page_size, order=order)
+        query.order = SQL('%s, %s', Product._graphql_get_search_relevance_order(search, sort['relevance'].value),
+                          query.order)
+        products = Product.browse(query)
+    else:
+        products = Product.search(domain, order=order, limit=page_size, offset=offset)
+    total_count = Product.search_count(domain) if with_count else 0
+
+    # Attempt to restrict the attribute values to the category filtering attributes, otherwise fallback to
+    # attribute values from products
     category = None
+    attribute_ids = None
     if kwargs.get('category_id'):
         category = Category.search([('id', 'in', kwargs['category_id'])], limit=1)
     elif kwargs.get('category_slug'):
         category = Category.search([('website_slug', '=', kwargs['category_slug'])], limit=1)
     if category:
-        attribute_values = category.\
-            mapped('attribute_ids').\
-            mapped('value_ids').\
-            filtered(lambda av: av.visibility and av.visibility == 'visible')
+        attribute_ids = category.attribute_ids.filtered(
+            lambda a: a.visibility and a.visibility == 'visible').ids
 
     # The partial domain is being used because when we select (example) attributes, the full list of products is
     # reduced which in turn also reduces the full list of attribute values, prices and warehouses
-    if domain == partial_domain:
-        without_filters_products = products
-    else:
-        without_filters_products = Product.search(partial_domain)
-
-    # Attributes from category, they still need to be filtered based on the products we are returning
-    if attribute_values:
-        category_attribute_value_ids = attribute_values.ids
-        product_attribute_value_ids = without_filters_products.\
-            mapped('variant_attribute_value_ids').\
-            filtered(lambda av: av.visibility and av.visibility == 'visible').ids
-        # Convert lists to sets and find the intersection to make sure attributes from category exist on products
-        common_ids = list(set(category_attribute_value_ids) & set(product_attribute_value_ids))
-        attribute_values = attribute_values.filtered(lambda av: av.id in common_ids)
-    else:
-        # Attributes from products
-        attribute_values = without_filters_products.\
-            mapped('variant_attribute_value_ids').\
-            filtered(lambda av: av.visibility and av.visibility == 'visible')
-
-    prices = without_filters_products.mapped('list_price')
+    attribute_value_counts = Product._graphql_get_attribute_value_counts(partial_domain, attribute_ids)
+    attribute_values = env['product.attribute.value'].sudo().with_context(
+        vsf_attribute_value_counts=attribute_value_counts).browse(list(attribute_value_counts))
 
-    total_count = len(products)
-    products = products[offset:offset + page_size]
+    # Min and max prices are aggregated in a single query instead of browsing every product
+    [(min_price, max_price)] = Product._read_group(
+        partial_domain, aggregates=['list_price:min', 'list_price:max'])
 
-    if prices:
-        return products, total_count, attribute_values, min(prices), max(prices)
-    return products, total_count, attribute_values, 0.0, 0.0
+    return products, total_count, attribute_values, min_price or 0.0, max_price or 0.0, end_cursor, has_next_page
 
 
 class Products(graphene.Interface):
@@ -74,6 +76,8 @@ class Products(graphene.Interface):
     attribute_values = graphene.List(AttributeValue)
     min_price = graphene.Float()
     max_price = graphene.Float()
+    end_cursor = graphene.String()
+    has_next_page = graphene.Boolean()
 
 
 class ProductList(graphene.ObjectType):
@@ -99,6 +103,7 @@ class ProductSortInput(graphene.InputObjectType):
     price = SortEnum()
     popular = SortEnum()
     newest = SortEnum()
+    relevance = SortEnum(description='Only used with a search, not available in cursor mode')
 
 
 class ProductVariant(graphene.Interface):
@@ -130,7 +135,14 @@ class ProductQuery(graphene.ObjectType):
         current_page=graphene.Int(default_value=1),
         page_size=graphene.Int(default_value=20),
         search=graphene.String(default_value=False),
-        sort=graphene.Argument(ProductSortInput, default_value={})
+        sort=graphene.Argument(ProductSortInput, default_value={}),
+        after=graphene.String(default_value=None, description='Cursor mode: end cursor of the previous page'),
+        first=graphene.Int(default_value=None, description='Cursor mode: number of products to return')
+    )
+    product_suggest = graphene.List(
+        graphene.NonNull(ProductSuggestion),
+        prefix=graphene.String(required=True),
+        limit=graphene.Int(default_value=10),
     )
     attribute = graphene.Field(
         Attribute,
@@ -165,12 +177,31 @@ class ProductQuery(graphene.ObjectType):
         return product
 
     @staticmethod
-    def resolve_products(self, info, filter, current_page, page_size, search, sort):
+    def resolve_products(self, info, filter, current_page, page_size, search, sort, after=None, first=None):
         env = info.context["env"]
-        products, total_count, attribute_values, min_price, max_price = get_product_list(
-            env, current_page, page_size, search, sort, **filter)
+        products, total_count, attribute_values, min_price, max_price, end_cursor, has_next_page = \
+            get_product_list(env, current_page, page_size, search, sort, after=after, first=first,
+                             with_count=is_field_selected(info, 'total_count'), **filter)
+        prefetch_selection(info, products, 'products')
         return ProductList(products=products, total_count=total_count, attribute_values=attribute_values,
-                           min_price=min_price, max_price=max_price)
+                           min_price=min_price, max_price=max_price, end_cursor=end_cursor,
+                           has_next_page=has_next_page)
+
+    @staticmethod
+    def resolve_product_suggest(self, info, prefix, limit):
+        """ Lightweight typeahead, matches the product and category names starting with the prefix """
+        env = info.context["env"]
+        Product = env['product.template'].sudo()
+
+        prefix = prefix.strip()
+        if not prefix or limit < 1:
+            return Product
+
+        # Names starting with the prefix, its wildcards are matched literally
+        pattern = escape_psql(prefix) + '%'
+        domain = expression.AND([Product._graphql_get_search_domain(False)[0], [
+            '|', ('name', '=ilike', pattern), ('public_categ_ids.name', '=ilike', pattern)]])
+        return Product.search_fetch(domain, ['name', 'website_slug'], limit=min(limit, 50))
 
     @staticmethod
     def resolve_attribute(self, info, id):